@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the gTTS path of local_tts_server.py.
+Runs a local stand-in for the Google Translate TTS endpoint with a fixed
+latency and times a /tts-sized text through the old path (gTTS saving each
+sentence to a temporary file, one after another) and through the engine's
+synthesize_text(), with the cache disabled. Only needs gTTS installed.
+
+Usage: python3 bench_gtts.py [--latency 0.15] [--runs 5]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STANDIN_PORT = 9100
+TEXT = ("Welcome back to Headroom. Your next session starts in five minutes. "
+        "Take a moment to breathe and relax your shoulders. Close any tabs you do not need. "
+        "When you are ready, press start and focus on a single task, leaving email, chat and the news "
+        "for later, because every interruption costs you several minutes of getting back into the flow. "
+        "I will remind you when it is time for a break. "
+        "Remember to drink some water during the session. Good luck, and have a productive afternoon.")
+
+# Must be set before local_tts_server is imported
+os.environ["GTTS_URL"] = f"http://127.0.0.1:{STANDIN_PORT}"
+os.environ["TTS_CACHE_SWEEP_INTERVAL"] = "0"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers batchexecute requests like Google Translate, after a fixed delay."""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536  # send headers and body in one segment, as a real server would
+    latency = 0.15
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        rpc = json.loads(urllib.parse.unquote(body[len("f.req="):].rstrip("&")))
+        text = json.loads(rpc[0][0][1])[0]
+        time.sleep(self.latency)
+        # A few hundred bytes of fake MP3 frames, different per piece of text
+        audio = (b"\xff\xf3" + text.encode()) * 8
+        line = '[["wrb.fr","jQ1olc","[\\"%s\\"]",null,null,null,"generic"]]' % base64.b64encode(audio).decode()
+        reply = (")]}'\n\n123\n" + line + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+def old_synthesize_text(text, split_sentences, join_segments):
+    """The path before in-memory synthesis: one temporary file per sentence, in sequence."""
+    from gtts import gTTS
+    segments = []
+    for sentence in split_sentences(text):
+        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
+            path = tmp.name
+        gTTS(text=sentence, lang="en", slow=True).save(path)
+        with open(path, "rb") as f:
+            segments.append(f.read())
+        os.unlink(path)
+    return join_segments(segments)
+
+
+def timed(func, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = func()
+    return (time.perf_counter() - start) / runs * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.15, help="stand-in latency in seconds")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    StandInHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", STANDIN_PORT), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gtts.tts
+    import local_tts_server
+    from tts_cache import AudioCache
+    from tts_core import split_sentences
+    from tts_audio import join_segments
+
+    # Old path: gTTS's own URL, redirected to the stand-in
+    gtts.tts._translate_url = lambda tld="com", path="": f"http://127.0.0.1:{STANDIN_PORT}/{path}"
+
+    engine = local_tts_server.OpenVoiceTTSEngine()
+    sentences = split_sentences(TEXT)
+    print(f"{len(TEXT)} characters, {len(sentences)} sentences, {args.latency * 1000:.0f} ms stand-in latency")
+
+    old_ms, old_audio = timed(lambda: old_synthesize_text(TEXT, split_sentences, join_segments), args.runs)
+
+    def new():
+        # A fresh, empty cache each run so every sentence is fetched
+        with tempfile.TemporaryDirectory(prefix="bench-gtts-") as cache_dir:
+            engine.cache = AudioCache(cache_dir, sweep_interval=0)
+            return engine.synthesize_text(TEXT, "default", "default")
+
+    new_ms, new_audio = timed(new, args.runs)
+    print(f"sequential temp files: {old_ms:7.0f} ms")
+    print(f"in memory, concurrent: {new_ms:7.0f} ms")
+    print("identical audio" if old_audio == new_audio else "AUDIO DIFFERS")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
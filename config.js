@@ -14,7 +14,8 @@ const TTS_CONFIG = {
   // TTS server configuration
   openVoiceURL: 'http://localhost:8008',  // Custom TTS server URL
   openVoiceModel: 'clear',  // The model to use
-  openVoiceSpeaker: 'default' // The speaker ID to use
+  openVoiceSpeaker: 'default', // The speaker ID to use
+  openVoiceStreaming: true  // Start playback after the first sentence instead of the whole response
 };
 
 // Speech-to-Text (STT) configuration
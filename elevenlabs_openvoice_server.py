@@ -6,13 +6,15 @@ This implementation connects to ElevenLabs for high-quality voices.
 
 import os
 import sys
-import json
 import time
 import logging
-import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from tts_core import FallbackAudio, TTSEngine, TTSServer
+from tts_cache import AudioCache, cache_name
 import io
+import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 
 # Set up logging
 logging.basicConfig(
@@ -24,79 +26,151 @@ logger = logging.getLogger("elevenlabs-openvoice")
 # Constants
 PORT = 8008
 CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+audio_cache = AudioCache(CACHE_DIR)
 
-# ElevenLabs API settings
-ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1"
+# ElevenLabs API settings (point ELEVENLABS_API_URL at a local stand-in for testing)
+ELEVENLABS_API_URL = os.environ.get("ELEVENLABS_API_URL", "https://api.elevenlabs.io/v1").rstrip("/")
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY", "")
+ELEVENLABS_CONNECT_TIMEOUT = float(os.environ.get("ELEVENLABS_CONNECT_TIMEOUT", "3.05"))
+ELEVENLABS_READ_TIMEOUT = float(os.environ.get("ELEVENLABS_READ_TIMEOUT", "30"))
+ELEVENLABS_MAX_CONCURRENCY = int(os.environ.get("ELEVENLABS_MAX_CONCURRENCY", "4"))
+ELEVENLABS_RETRIES = int(os.environ.get("ELEVENLABS_RETRIES", "3"))
+ELEVENLABS_RETRY_BACKOFF = float(os.environ.get("ELEVENLABS_RETRY_BACKOFF", "0.5"))
 
-class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
-    # Handle CORS preflight requests
-    def do_OPTIONS(self):
-        logger.info("Handling OPTIONS request (CORS preflight)")
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '86400')  # 24 hours
-        self.end_headers()
+# Upstream responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Largest piece of a streamed response relayed at once (about 0.25 s of 128 kbps MP3)
+STREAM_CHUNK_SIZE = 4096
+
+class ElevenLabsClient:
+    """Pooled keep-alive client for the ElevenLabs API.
     
-    def send_cors_headers(self):
-        """Add CORS headers to response."""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    One requests.Session reuses TCP/TLS connections across requests. Every call
+    has connect and read timeouts, at most ELEVENLABS_MAX_CONCURRENCY calls are
+    in flight at once, and 429/5xx responses and connection errors are retried
+    with jittered exponential backoff (honoring Retry-After). Streamed calls
+    are only retried until the response starts.
+    """
     
-    def do_GET(self):
-        if self.path == "/health":
-            logger.info("Health check request received")
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok", "engine": "elevenlabs-openvoice"}).encode())
-        
-        elif self.path == "/voices":
-            logger.info("Voices request received")
-            voices = self.get_voices()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"voices": voices}).encode())
+    def __init__(self, base_url=ELEVENLABS_API_URL, api_key=ELEVENLABS_API_KEY,
+                 max_concurrency=ELEVENLABS_MAX_CONCURRENCY, retries=ELEVENLABS_RETRIES,
+                 timeout=(ELEVENLABS_CONNECT_TIMEOUT, ELEVENLABS_READ_TIMEOUT)):
+        self.base_url = base_url
+        self.retries = max(0, retries)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_concurrency))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"xi-api-key": api_key, "Content-Type": "application/json"})
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+    
+    def backoff(self, attempt, response=None):
+        """Seconds to wait before retry number attempt (full jitter, capped at 8s)."""
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), 30)
+        return random.uniform(0, min(8, ELEVENLABS_RETRY_BACKOFF * 2 ** attempt))
+    
+    def send(self, method, path, stream=False, **kwargs):
+        """Send a request to the API, retrying failures, and return the final response.
         
-        elif self.path == "/models":
-            logger.info("Models request received")
-            models = [
-                {"id": "eleven_multilingual_v2", "name": "ElevenLabs Multilingual v2", "status": "ready"},
-                {"id": "eleven_turbo_v2", "name": "ElevenLabs Turbo v2", "status": "ready"},
-                {"id": "eleven_enhanced", "name": "ElevenLabs Enhanced", "status": "ready"},
-                {"id": "eleven_monolingual_v1", "name": "ElevenLabs Monolingual v1", "status": "ready"}
-            ]
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"models": models}).encode())
+        The response is returned holding a concurrency slot, which the caller
+        releases once it is done with the body; without stream the body has
+        already been read. Raises requests.RequestException when the call still
+        fails after retries; other error statuses are returned to the caller.
+        """
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            response = None
+            self.requests += 1
+            self.slots.acquire()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, stream=stream, **kwargs)
+                if not stream:
+                    response.content
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                if attempt >= self.retries:
+                    self.failures += 1
+                    return response
+                response.close()
+                self.slots.release()
+                logger.warning(f"ElevenLabs {method} {path} returned {response.status_code}, retrying")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.slots.release()
+                if attempt >= self.retries:
+                    self.failures += 1
+                    raise
+                logger.warning(f"ElevenLabs {method} {path} failed ({e}), retrying")
+            except BaseException:
+                self.slots.release()
+                raise
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+            self.retried += 1
+    
+    def request(self, method, path, **kwargs):
+        """Send a request to the API and return the response with its body read."""
+        response = self.send(method, path, **kwargs)
+        self.slots.release()
+        return response
+    
+    def stream(self, method, path, **kwargs):
+        """Yield the body of a successful call chunk by chunk as it arrives.
         
-        else:
-            logger.warning(f"Unknown GET request for path: {self.path}")
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+        Raises an exception instead when the API answers with an error status.
+        The call keeps its concurrency slot until the generator is closed.
+        """
+        response = self.send(method, path, stream=True, **kwargs)
+        try:
+            if response.status_code != 200:
+                raise Exception(f"ElevenLabs API error: {response.status_code} - {response.text}")
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+            self.slots.release()
+    
+    def stats(self):
+        return {"url": self.base_url, "requests": self.requests, "retries": self.retried,
+                "failures": self.failures}
+
+class ElevenLabsOpenVoiceTTSEngine(TTSEngine):
+    """ElevenLabs engine (with gTTS fallback) served by the shared TTS server core."""
+
+    name = "elevenlabs-openvoice"
+    cache = audio_cache
+    default_voice = "21m00Tcm4TlvDq8ikWAM"  # Rachel by default
+    default_model = "eleven_multilingual_v2"
+    content_type = "audio/mpeg"
+    client = ElevenLabsClient()
+
+    def health(self):
+        """Return the /health payload, including upstream API call counts."""
+        status = super().health()
+        status["upstream"] = self.client.stats()
+        return status
+
+    def get_models(self):
+        """Return available ElevenLabs models."""
+        return [
+            {"id": "eleven_multilingual_v2", "name": "ElevenLabs Multilingual v2", "status": "ready"},
+            {"id": "eleven_turbo_v2", "name": "ElevenLabs Turbo v2", "status": "ready"},
+            {"id": "eleven_enhanced", "name": "ElevenLabs Enhanced", "status": "ready"},
+            {"id": "eleven_monolingual_v1", "name": "ElevenLabs Monolingual v1", "status": "ready"}
+        ]
     
     def get_voices(self):
         """Get available voices from ElevenLabs or fallback to hardcoded list if API key is missing."""
         # If we have an API key, try to get voices from ElevenLabs
         if ELEVENLABS_API_KEY:
             try:
-                headers = {
-                    "xi-api-key": ELEVENLABS_API_KEY,
-                    "Content-Type": "application/json"
-                }
-                response = requests.get(f"{ELEVENLABS_API_URL}/voices", headers=headers)
+                response = self.client.request("GET", "/voices")
                 if response.status_code == 200:
                     data = response.json()
                     voices = []
@@ -135,43 +209,9 @@ class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
             {"id": "t0jbNlBVZ17f02VDIeMI", "name": "Hiroshi (Japanese)", "language": "ja-JP", "status": "ready"}
         ]
     
-    def do_POST(self):
-        if self.path == "/tts":
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request = json.loads(post_data.decode())
-            text = request.get("text", "")
-            speaker = request.get("speaker", "21m00Tcm4TlvDq8ikWAM")  # Rachel by default
-            model = request.get("model", "eleven_multilingual_v2")
-            
-            logger.info(f"TTS request: text='{text[:50]}...', speaker='{speaker}', model='{model}'")
-            
-            try:
-                # Generate audio
-                audio_data = self.generate_audio(text, speaker, model)
-                
-                # Return audio
-                self.send_response(200)
-                self.send_header('Content-type', 'audio/mpeg')
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(audio_data)
-                
-                logger.info(f"Response sent successfully: {len(audio_data)} bytes")
-                
-            except Exception as e:
-                logger.error(f"Error generating TTS: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+    def synthesize(self, text, voice_id, model):
+        """Generate audio with ElevenLabs or the gTTS fallback."""
+        return self.generate_audio(text, voice_id, model)
     
     def map_model_to_elevenlabs(self, model):
         """Map our model names to ElevenLabs model IDs."""
@@ -183,57 +223,95 @@ class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
         }
         return model_mapping.get(model, "eleven_multilingual_v2")
     
+    def speech_request(self, text, model):
+        """Build the JSON body of a text-to-speech call."""
+        return {
+            "text": text,
+            "model_id": self.map_model_to_elevenlabs(model),
+            "voice_settings": {
+                "stability": 0.5,
+                "similarity_boost": 0.75
+            }
+        }
+    
+    def open_stream(self, text, voice_id, model):
+        """Relay ElevenLabs audio for a sentence chunk by chunk as it arrives.
+        
+        Cached sentences and the gTTS fallback are returned as a single chunk;
+        without an API key the server synthesizes the sentence whole instead.
+        """
+        key = cache_name(self.name, "mp3", text, voice_id, model)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info(f"Using cached audio for: '{text[:30]}...'")
+            return iter((cached,))
+        if not ELEVENLABS_API_KEY:
+            return None
+        
+        start_time = time.time()
+        logger.info(f"Streaming from ElevenLabs API for voice_id: {voice_id}")
+        chunks = self.client.stream("POST", f"/text-to-speech/{voice_id}/stream",
+                                    json=self.speech_request(text, model))
+        try:
+            first = next(chunks)
+        except Exception as e:
+            logger.error(f"Error using ElevenLabs API: {str(e)}")
+            logger.info("Falling back to gTTS...")
+            return iter((FallbackAudio(self.generate_fallback(text, voice_id, start_time)),))
+        return self.tee_to_cache(key, first, chunks, start_time, voice_id, model)
+    
+    def tee_to_cache(self, key, first, chunks, start_time, voice_id, model):
+        """Yield streamed chunks while writing them to the cache.
+        
+        The entry is only committed once the whole response has arrived; a
+        failed or abandoned stream leaves nothing in the cache.
+        """
+        writer = self.cache.writer(key, engine=self.name, voice=voice_id, model=model)
+        committed = False
+        try:
+            writer.write(first)
+            yield first
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+            writer.commit(cost=time.time() - start_time)
+            committed = True
+        finally:
+            chunks.close()
+            if not committed:
+                logger.warning(f"ElevenLabs stream for {key} did not complete, not caching it")
+                writer.abort()
+    
     def generate_audio(self, text, voice_id, model):
         """Generate audio for text using ElevenLabs API or fallback to gTTS."""
-        import hashlib
-        
         logger.info(f"Generating speech for: '{text[:50]}...'")
         
         # Create a cache key based on the text, voice, and model
-        cache_key = hashlib.md5(f"{text}_{voice_id}_{model}".encode()).hexdigest()
-        cache_path = os.path.join(CACHE_DIR, f"{cache_key}.mp3")
+        key = cache_name(self.name, "mp3", text, voice_id, model)
         
         # Check if we have this in cache
-        if os.path.exists(cache_path):
+        cached = self.cache.get(key)
+        if cached is not None:
             logger.info(f"Using cached audio for: '{text[:30]}...'")
-            with open(cache_path, "rb") as f:
-                return f.read()
+            return cached
+        
+        start_time = time.time()
         
         # Try ElevenLabs if API key is available
         if ELEVENLABS_API_KEY:
             try:
                 logger.info(f"Using ElevenLabs API for voice_id: {voice_id}")
                 
-                headers = {
-                    "xi-api-key": ELEVENLABS_API_KEY,
-                    "Content-Type": "application/json"
-                }
-                
-                elevenlabs_model = self.map_model_to_elevenlabs(model)
-                
-                data = {
-                    "text": text,
-                    "model_id": elevenlabs_model,
-                    "voice_settings": {
-                        "stability": 0.5,
-                        "similarity_boost": 0.75
-                    }
-                }
-                
-                response = requests.post(
-                    f"{ELEVENLABS_API_URL}/text-to-speech/{voice_id}",
-                    json=data,
-                    headers=headers,
-                    stream=True
-                )
+                response = self.client.request("POST", f"/text-to-speech/{voice_id}",
+                                               json=self.speech_request(text, model))
                 
                 if response.status_code == 200:
                     # Read all audio data
                     audio_data = response.content
                     
                     # Save to cache
-                    with open(cache_path, "wb") as f:
-                        f.write(audio_data)
+                    self.cache.put(key, audio_data, cost=time.time() - start_time,
+                                   engine=self.name, voice=voice_id, model=model)
                     
                     return audio_data
                 else:
@@ -245,6 +323,10 @@ class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
                 logger.info("Falling back to gTTS...")
         
         # Fallback to gTTS if ElevenLabs fails or API key is missing
+        return FallbackAudio(self.generate_fallback(text, voice_id, start_time))
+    
+    def generate_fallback(self, text, voice_id, start_time):
+        """Generate audio for text with gTTS."""
         try:
             from gtts import gTTS
             
@@ -262,6 +344,14 @@ class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
             
             language = language_mapping.get(voice_id, "en")
             
+            # gTTS output is cached in its own namespace so it is never served
+            # as ElevenLabs audio once the API is reachable again
+            key = cache_name("gtts", "mp3", text, language)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"Using cached gTTS audio for: '{text[:30]}...'")
+                return cached
+            
             # Generate speech with gTTS
             tts = gTTS(text=text, lang=language, slow=False)
             
@@ -271,8 +361,8 @@ class ElevenLabsOpenVoiceTTSHandler(BaseHTTPRequestHandler):
             mp3_data = mp3_buffer.getvalue()
             
             # Save to cache
-            with open(cache_path, "wb") as f:
-                f.write(mp3_data)
+            self.cache.put(key, mp3_data, cost=time.time() - start_time,
+                           engine="gtts", voice=language, model="gtts")
             
             return mp3_data
             
@@ -308,12 +398,11 @@ def run_server():
         logger.error("Server cannot run without these libraries. Exiting.")
         sys.exit(1)
     
-    server_address = ('', PORT)
-    httpd = HTTPServer(server_address, ElevenLabsOpenVoiceTTSHandler)
+    server = TTSServer(ElevenLabsOpenVoiceTTSEngine(), port=PORT)
     logger.info(f"Starting OpenVoice TTS server with ElevenLabs on port {PORT}")
     logger.info(f"Server running at http://localhost:{PORT}")
     try:
-        httpd.serve_forever()
+        server.run()
     except KeyboardInterrupt:
         logger.info("Server stopped")
 
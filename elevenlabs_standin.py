@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the ElevenLabs API, for testing elevenlabs_openvoice_server.py
+without an API key or network access. Answers /voices, /text-to-speech/<voice>
+and /text-to-speech/<voice>/stream with fake MP3 frames made from the text,
+and can be told to fail calls with 429/5xx statuses first.
+
+Usage: python3 elevenlabs_standin.py [--port 9000] [--latency 0.2] [--fail-every 0]
+Then: ELEVENLABS_API_URL=http://localhost:9000/v1 ELEVENLABS_API_KEY=test python3 elevenlabs_openvoice_server.py
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VOICES = [
+    {"voice_id": "21m00Tcm4TlvDq8ikWAM", "name": "Rachel", "labels": {"language": "en"}},
+    {"voice_id": "AZnzlk1XvdvUeBnXmlld", "name": "Domi", "labels": {"language": "en"}},
+]
+
+
+def fake_audio(text):
+    """Fake MP3 frames, different per text."""
+    return b"\xff\xf3" + text.encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers ElevenLabs API calls, after the server's latency."""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536  # send headers and body in one segment, as a real server would
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_call(self, body=None):
+        """Record the call and answer it with a scripted failure if one is due. Returns True if it did."""
+        failure = self.server.record(self.command, self.path, self.headers.get("xi-api-key"),
+                                     self.client_address[1], body)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if failure is None:
+            return False
+        status, retry_after = failure
+        headers = [] if retry_after is None else [("Retry-After", str(retry_after))]
+        self.send_body(status, json.dumps({"detail": "stand-in failure"}).encode(), headers=headers)
+        return True
+
+    def do_GET(self):
+        if self.handle_call():
+            return
+        if self.path != "/v1/voices":
+            self.send_body(404, b'{"detail": "not found"}')
+            return
+        self.send_body(200, json.dumps({"voices": VOICES}).encode())
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.handle_call(body):
+            return
+        if not self.path.startswith("/v1/text-to-speech/"):
+            self.send_body(404, b'{"detail": "not found"}')
+            return
+        audio = fake_audio(body.get("text", ""))
+        if not self.path.endswith("/stream"):
+            self.send_body(200, audio, "audio/mpeg")
+            return
+        # Stream the audio in a few chunks, as the real endpoint does while it synthesizes
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(audio), 4):
+            chunk = audio[start:start + 4]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StandInServer(ThreadingHTTPServer):
+    """The stand-in API, recording the calls it gets.
+
+    fail() queues failures that are returned for the next calls; with
+    fail_every, every nth call fails with a 503 as well.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, fail_every=0):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.failures = []
+        self.calls = []
+        self.ports = set()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def fail(self, status, times=1, retry_after=None):
+        """Answer the next times calls with status, and Retry-After if given."""
+        with self.lock:
+            self.failures.extend([(status, retry_after)] * times)
+
+    def record(self, method, path, api_key, port, body):
+        """Record a call and return the failure to answer it with, if any."""
+        with self.lock:
+            self.calls.append((method, path, api_key, body))
+            self.ports.add(port)
+            if self.failures:
+                return self.failures.pop(0)
+            if self.fail_every and len(self.calls) % self.fail_every == 0:
+                return 503, None
+            return None
+
+    def start(self):
+        """Serve from a background thread."""
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up in the middle of a stream are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before each answer")
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every nth call with a 503")
+    args = parser.parse_args()
+
+    server = StandInServer(("127.0.0.1", args.port), args.latency, args.fail_every)
+    print(f"ElevenLabs stand-in at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
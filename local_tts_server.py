@@ -5,14 +5,16 @@ Local TTS Server for Headroom using system voices.
 
 import os
 import sys
-import json
 import time
+import base64
 import logging
-import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+from urllib.request import getproxies
+from tts_core import FallbackAudio, TTSEngine, TTSServer
+from tts_cache import AudioCache, cache_name
 import io
-import hashlib
-import threading
 import re
 
 # Set up logging
@@ -25,7 +27,17 @@ logger = logging.getLogger("localtts")
 # Constants
 PORT = 8008
 CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+audio_cache = AudioCache(CACHE_DIR)
+
+# gTTS settings: the pieces of all sentences being synthesized are fetched by a bounded pool
+GTTS_FETCH_WORKERS = int(os.environ.get("GTTS_FETCH_WORKERS", "8"))
+GTTS_CONNECT_TIMEOUT = float(os.environ.get("GTTS_CONNECT_TIMEOUT", "3.05"))
+GTTS_READ_TIMEOUT = float(os.environ.get("GTTS_READ_TIMEOUT", "15"))
+# Base URL of the Google Translate endpoint; point it at a local stand-in for benchmarking
+GTTS_URL = os.environ.get("GTTS_URL", "").rstrip("/")
+
+# Audio in a Google Translate TTS response line (the pattern gTTS itself uses)
+GTTS_AUDIO = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
 
 # Import basic libraries
 try:
@@ -37,7 +49,7 @@ except ImportError as e:
 
 # Try to import gTTS for text-to-speech
 try:
-    from gtts import gTTS
+    from gtts import gTTS, gTTSError
     SYSTEM_TTS_AVAILABLE = True
     logger.info("Using gTTS for text-to-speech")
 except ImportError:
@@ -45,112 +57,95 @@ except ImportError:
     try:
         import subprocess
         subprocess.check_call([sys.executable, "-m", "pip", "install", "gtts"])
-        from gtts import gTTS
+        from gtts import gTTS, gTTSError
         SYSTEM_TTS_AVAILABLE = True
         logger.info("Successfully installed and imported gTTS")
     except Exception as e:
         logger.error(f"Failed to install gTTS: {e}")
         SYSTEM_TTS_AVAILABLE = False
 
-# Set to use system TTS instead of OpenVoice
-OPENVOICE_AVAILABLE = False
+class GTTSFetcher:
+    """Synthesizes speech with gTTS in memory, fetching the pieces of a long text concurrently.
 
-# Path to model checkpoints - adjust as needed
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "OpenVoice", "resources", "pretrained")
+    gTTS splits text into pieces of at most 100 characters and requests them
+    one after another, each over a new connection. Here the requests gTTS
+    prepares are sent through one keep-alive session by a bounded thread pool,
+    and the MP3 frames of the pieces are joined in order. The pool is shared
+    by the sentences synthesize_text() runs concurrently, so it bounds the
+    number of requests to Google across the whole server. Should a gTTS
+    release change the internals this relies on, gTTS fetches the text itself.
+    """
 
-# Initialize TTS models
-tts_model = None
-converter_model = None
+    def __init__(self, workers=GTTS_FETCH_WORKERS, base_url=GTTS_URL):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.base_url = base_url
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gtts-fetch")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-if OPENVOICE_AVAILABLE:
-    try:
-        # Load paths for the models
-        base_model_path = os.path.join(MODEL_DIR, "base_speakers", "EN", "config.json")
-        base_model_ckpt = os.path.join(MODEL_DIR, "base_speakers", "EN", "best_model.pth")
-        
-        converter_path = os.path.join(MODEL_DIR, "converter", "config.json")
-        converter_ckpt = os.path.join(MODEL_DIR, "converter", "best_model.pth")
-        
-        # Initialize models if files exist
-        if os.path.exists(base_model_path) and os.path.exists(base_model_ckpt):
-            logger.info("Loading OpenVoice base speaker model...")
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            logger.info(f"Using device: {device}")
-            
-            tts_model = BaseSpeakerTTS(base_model_path, device=device)
-            tts_model.load_ckpt(base_model_ckpt)
-            logger.info("Base speaker model loaded successfully")
-            
-            if os.path.exists(converter_path) and os.path.exists(converter_ckpt):
-                logger.info("Loading OpenVoice converter model...")
-                converter_model = ToneColorConverter(converter_path, device=device, enable_watermark=False)
-                converter_model.load_ckpt(converter_ckpt)
-                logger.info("Converter model loaded successfully")
-        else:
-            logger.error(f"Model files not found. Please download them first.")
-            logger.error(f"Expected paths: {base_model_path}, {base_model_ckpt}")
-            OPENVOICE_AVAILABLE = False
-    except Exception as e:
-        logger.error(f"Error loading OpenVoice models: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        OPENVOICE_AVAILABLE = False
+    def synthesize(self, text, lang, slow):
+        """Return the MP3 audio for text."""
+        tts = gTTS(text=text, lang=lang, slow=slow)
+        try:
+            # gTTS's own split of the text, one prepared request per piece
+            pieces = tts._prepare_requests()
+        except AttributeError:
+            # A gTTS release without this private helper
+            logger.warning("gTTS cannot prepare its requests, letting it fetch the pieces itself")
+            return self.synthesize_with_gtts(tts)
+        frames = list(self.pool.map(partial(self.fetch, tts), pieces))
+        if None in frames:
+            logger.warning("Unrecognized gTTS response, letting gTTS fetch the pieces itself")
+            return self.synthesize_with_gtts(tts)
+        return b"".join(frames)
 
-class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
-    # Handle CORS preflight requests
-    def do_OPTIONS(self):
-        logger.info("Handling OPTIONS request (CORS preflight)")
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '86400')  # 24 hours
-        self.end_headers()
-    
-    def send_cors_headers(self):
-        """Add CORS headers to response."""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-    
-    def do_GET(self):
-        if self.path == "/health":
-            logger.info("Health check request received")
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok", "engine": "custom-openvoice"}).encode())
-        
-        elif self.path == "/voices":
-            logger.info("Voices request received")
-            voices = self.get_voices()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"voices": voices}).encode())
-        
-        elif self.path == "/models":
-            logger.info("Models request received")
-            models = [
-                {"id": "default", "name": "Default", "status": "ready"},
-                {"id": "clear", "name": "Clear Speech", "status": "ready"},
-                {"id": "expressive", "name": "Expressive", "status": "ready"}
-            ]
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"models": models}).encode())
-        
-        else:
-            logger.warning(f"Unknown GET request for path: {self.path}")
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+    def synthesize_with_gtts(self, tts):
+        """Return the MP3 audio for text the way gTTS fetches it, one piece after another."""
+        buffer = io.BytesIO()
+        tts.write_to_fp(buffer)
+        return buffer.getvalue()
+
+    def fetch(self, tts, piece):
+        """Send the request for one piece of text and return its MP3 frames.
+
+        Returns None when the response is not in the format GTTS_AUDIO expects.
+        """
+        import requests
+        if self.base_url:
+            piece.url = self.base_url + urlsplit(piece.url).path
+        # Session.send() skips the proxy settings Session.request() would apply;
+        # use the same proxies as gTTS
+        settings = self.session.merge_environment_settings(piece.url, getproxies(), None, None, None)
+        timeout = tts.timeout if tts.timeout is not None else (GTTS_CONNECT_TIMEOUT, GTTS_READ_TIMEOUT)
+        try:
+            response = self.session.send(piece, timeout=timeout, **settings)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise gTTSError(tts=tts, response=e.response)
+        frames = [base64.b64decode(match.group(1)) for match in GTTS_AUDIO.finditer(response.text)]
+        if not frames:
+            return None
+        return b"".join(frames)
+
+
+class OpenVoiceTTSEngine(TTSEngine):
+    """gTTS engine served by the shared TTS server core."""
+
+    name = "custom-openvoice"
+    cache = audio_cache
+    content_type = "audio/mpeg"
+    fetcher = GTTSFetcher() if SYSTEM_TTS_AVAILABLE else None
+
+    def get_models(self):
+        """Return available speaking styles."""
+        return [
+            {"id": "default", "name": "Default", "status": "ready"},
+            {"id": "clear", "name": "Clear Speech", "status": "ready"},
+            {"id": "expressive", "name": "Expressive", "status": "ready"}
+        ]
     
     def get_voices(self):
         """Return available gTTS voice options."""
@@ -169,69 +164,31 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
         logger.info(f"Returning {len(voice_list)} gTTS voices")
         return voice_list
     
-    def do_POST(self):
-        if self.path == "/tts":
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                request = json.loads(post_data.decode())
-                text = request.get("text", "")
-                voice_id = request.get("speaker", "default")
-                model = request.get("model", "default")
-                
-                logger.info(f"TTS request: text='{text[:50]}...', voice='{voice_id}', model='{model}'")
-                
-                # Generate speech audio using our custom offline synthesis
-                audio_data = self.generate_speech(text, voice_id, model)
-                
-                # Return audio
-                self.send_response(200)
-                self.send_header('Content-type', 'audio/wav')
-                self.send_header('Content-Length', str(len(audio_data)))
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(audio_data)
-                
-                logger.info(f"Response sent successfully: {len(audio_data)} bytes")
-                
-            except Exception as e:
-                logger.error(f"Error handling TTS request: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+    def synthesize(self, text, voice_id, model):
+        """Generate speech audio using gTTS."""
+        return self.generate_speech(text, voice_id, model)
     
     def generate_speech(self, text, voice_id, model):
         """Generate speech using gTTS or fallback to notification sound."""
         logger.info(f"Generating speech for: '{text[:50]}...', voice: {voice_id}, model: {model}")
         
         # Create a cache key
-        cache_key = hashlib.md5(f"{text}_{voice_id}_{model}_gtts".encode()).hexdigest()
-        cache_path = os.path.join(CACHE_DIR, f"{cache_key}.mp3")
+        key = cache_name(self.name, "mp3", text, voice_id, model)
         
         # Return cached audio if available
-        if os.path.exists(cache_path):
+        cached = self.cache.get(key)
+        if cached is not None:
             logger.info(f"Using cached audio for: '{text[:30]}...'")
-            with open(cache_path, 'rb') as f:
-                return f.read()
+            return cached
                 
+        start_time = time.time()
+        
         # Check if TTS is available
         if not SYSTEM_TTS_AVAILABLE:
             logger.error("gTTS not available. Using notification sound instead.")
-            return self.generate_notification_sound()
+            return FallbackAudio(self.generate_notification_sound())
             
         try:
-            # Create a temporary file for the audio
-            with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp:
-                output_path = tmp.name
-            
             # Map voice_id to language code
             lang = "en"
             if voice_id in ["olivia", "thomas"]:
@@ -252,35 +209,23 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             
             # Generate speech with gTTS
             logger.info(f"Generating speech with gTTS: lang={lang}, slow={not speed}")
-            tts = gTTS(text=text, lang=lang, slow=not speed)
-            tts.save(output_path)
+            audio_data = self.fetcher.synthesize(text, lang, not speed)
             
-            # Check if file was created successfully
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                # Read audio data
-                with open(output_path, 'rb') as f:
-                    audio_data = f.read()
-                    
-                # Clean up temporary file
-                try:
-                    os.unlink(output_path)
-                except:
-                    pass
-                    
+            if audio_data:
                 # Cache the audio
-                with open(cache_path, 'wb') as f:
-                    f.write(audio_data)
+                self.cache.put(key, audio_data, cost=time.time() - start_time,
+                               engine=self.name, voice=voice_id, model=model)
                     
                 return audio_data
             else:
-                logger.error("Failed to generate speech with gTTS - empty or missing file")
-                return self.generate_notification_sound()
+                logger.error("Failed to generate speech with gTTS - empty audio")
+                return FallbackAudio(self.generate_notification_sound())
                 
         except Exception as e:
             logger.error(f"Error generating speech with gTTS: {e}")
             import traceback
             logger.error(traceback.format_exc())
-            return self.generate_notification_sound()
+            return FallbackAudio(self.generate_notification_sound())
             
     def generate_notification_sound(self):
         """Return a valid audio sound as fallback when TTS is not available."""
@@ -343,12 +288,11 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
 
 def run_server():
     """Start the HTTP server."""
-    server_address = ('', PORT)
-    httpd = HTTPServer(server_address, OpenVoiceTTSHandler)
+    server = TTSServer(OpenVoiceTTSEngine(), port=PORT)
     logger.info(f"Starting OpenVoice TTS server on port {PORT}")
     logger.info(f"Server running at http://localhost:{PORT}")
     try:
-        httpd.serve_forever()
+        server.run()
     except KeyboardInterrupt:
         logger.info("Server stopped")
 
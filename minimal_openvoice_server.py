@@ -5,18 +5,14 @@ This implementation creates musical patterns based on text.
 """
 
 import os
-import sys
-import json
 import time
 import logging
-import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from tts_core import TTSEngine, TTSServer
+from tts_cache import AudioCache, MemoryLRU, cache_name
+from tts_audio import wav_header
 import numpy as np
 import wave
-import struct
-import math
 import io
-import hashlib
 import random
 
 # Set up logging
@@ -29,63 +25,89 @@ logger = logging.getLogger("openvoice")
 # Constants
 PORT = 8008
 CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+audio_cache = AudioCache(CACHE_DIR)
+# Memory budget for rendered word waveforms
+TTS_WORD_CACHE_BYTES = int(os.environ.get("TTS_WORD_CACHE_BYTES", str(16 * 1024 * 1024)))
 
-class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
-    # Handle CORS preflight requests
-    def do_OPTIONS(self):
-        logger.info("Handling OPTIONS request (CORS preflight)")
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '86400')  # 24 hours
-        self.end_headers()
+# Base frequencies of the pattern voices: male/female, plus the "_2" variants
+PATTERN_BASE_FREQS = (150, 150 * 1.1, 280, 280 * 1.1)
+
+class OscillatorBank:
+    """Sine wavetable and word frequencies for the pattern voices, computed once at startup.
     
-    def send_cors_headers(self):
-        """Add CORS headers to response."""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    Oscillators are read from the table by phase (in cycles) instead of calling
+    np.sin per sample. With 2**18 entries the lookup error of a carrier stays well
+    below one 16-bit step, so the rendered audio is the same as with np.sin.
+    """
     
-    def do_GET(self):
-        if self.path == "/health":
-            logger.info("Health check request received")
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok", "engine": "openvoice-pattern"}).encode())
-        
-        elif self.path == "/voices":
-            logger.info("Voices request received")
-            voices = self.get_voices()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"voices": voices}).encode())
-        
-        elif self.path == "/models":
-            logger.info("Models request received")
-            models = [
-                {"id": "default", "name": "Default", "status": "ready"},
-                {"id": "slow", "name": "Slow", "status": "ready"},
-                {"id": "fast", "name": "Fast", "status": "ready"}
-            ]
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"models": models}).encode())
+    TABLE_BITS = 18
+    
+    def __init__(self, base_freqs=PATTERN_BASE_FREQS):
+        size = 1 << self.TABLE_BITS
+        self.size = size
+        self.table = np.sin(2 * np.pi * np.arange(size) / size)
+        # Word frequency for each base frequency and first letter a-z
+        shifts = (np.arange(26) / 26.0) * 0.5 + 0.75  # Map to range 0.75 - 1.25
+        self.frequencies = {base_freq: base_freq * shifts for base_freq in base_freqs}
+    
+    def frequency(self, base_freq, first_char):
+        """Frequency of a word starting with first_char."""
+        letter = ord(first_char) - ord('a')
+        shifts = self.frequencies.get(base_freq)
+        if shifts is not None and 0 <= letter < 26:
+            return shifts[letter]
+        # Digits, punctuation and non-ASCII letters fall outside the bank
+        return base_freq * ((letter / 26.0) * 0.5 + 0.75)
+    
+    def sine(self, cycles):
+        """sin(2 * pi * cycles) for an array of non-negative phases."""
+        index = np.rint(cycles * self.size).astype(np.int64)
+        index &= self.size - 1
+        return self.table[index]
+    
+    def smooth_sine(self, cycles):
+        """Linearly interpolated sin(2 * pi * cycles), for modulators.
         
-        else:
-            logger.warning(f"Unknown GET request for path: {self.path}")
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+        A modulator's error is multiplied by the carrier phase, so it needs more
+        precision than a plain table lookup gives.
+        """
+        position = cycles * self.size
+        index = position.astype(np.int64)
+        fraction = position - index
+        index &= self.size - 1
+        low = self.table[index]
+        high = self.table[(index + 1) & (self.size - 1)]
+        return low + fraction * (high - low)
+
+oscillators = OscillatorBank()
+
+class OpenVoiceTTSEngine(TTSEngine):
+    """Musical pattern engine served by the shared TTS server core."""
+
+    name = "openvoice-pattern"
+    cache = audio_cache
+    cpu_bound = True
+    oscillators = oscillators
+    word_cache = MemoryLRU(TTS_WORD_CACHE_BYTES)
+
+    def health(self):
+        """Return the /health payload, including word waveform cache usage.
+
+        With a process pool words are rendered (and cached) in the synthesis
+        processes, whose caches this process cannot see, so the field is left out.
+        """
+        status = super().health()
+        if self.processes is None:
+            status["word_cache"] = {"entries": len(self.word_cache.entries), "bytes": self.word_cache.size}
+        return status
+
+    def get_models(self):
+        """Return available speed models."""
+        return [
+            {"id": "default", "name": "Default", "status": "ready"},
+            {"id": "slow", "name": "Slow", "status": "ready"},
+            {"id": "fast", "name": "Fast", "status": "ready"}
+        ]
     
     def get_voices(self):
         """Return available voice options."""
@@ -97,65 +119,42 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             {"id": "male_2", "name": "Male Pattern 2", "language": "en-US", "status": "ready"}
         ]
     
-    def do_POST(self):
-        if self.path == "/tts":
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                request = json.loads(post_data.decode())
-                text = request.get("text", "")
-                voice_id = request.get("speaker", "default")
-                model = request.get("model", "default")
-                
-                logger.info(f"TTS request: text='{text[:50]}...', voice='{voice_id}', model='{model}'")
-                
-                # Generate audio patterns based on text
-                audio_data = self.generate_audio_pattern(text, voice_id, model)
-                
-                # Return audio
-                self.send_response(200)
-                self.send_header('Content-type', 'audio/wav')
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(audio_data)
-                
-                logger.info(f"Response sent successfully: {len(audio_data)} bytes")
-                
-            except Exception as e:
-                logger.error(f"Error handling TTS request: {str(e)}")
-                try:
-                    # Send a simple tone as fallback
-                    fallback_audio = self.generate_simple_tone()
-                    self.send_response(200)
-                    self.send_header('Content-type', 'audio/wav')
-                    self.send_cors_headers()
-                    self.end_headers()
-                    self.wfile.write(fallback_audio)
-                except Exception:
-                    # If even that fails, send error
-                    self.send_response(500)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_cors_headers()
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": str(e)}).encode())
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+    def synthesize(self, text, voice_id, model):
+        """Generate audio patterns based on text."""
+        return self.generate_audio_pattern(text, voice_id, model)
+    
+    def fallback_audio(self):
+        """Send a simple tone as fallback."""
+        return self.generate_simple_tone()
+    
+    def warm_up(self):
+        """Run numpy through the rendering code once so the first request is fast."""
+        self.render_pattern("Warm up.", self.default_voice, self.default_model, "")
     
     def generate_audio_pattern(self, text, voice_id, model):
         """Generate sophisticated audio patterns based on text."""
         # Create a cache key
-        cache_key = hashlib.md5(f"{text}_{voice_id}_{model}".encode()).hexdigest()
-        cache_path = os.path.join(CACHE_DIR, f"{cache_key}.wav")
+        key = cache_name(self.name, "wav", text, voice_id, model)
         
         # Return cached audio if available
-        if os.path.exists(cache_path):
-            with open(cache_path, 'rb') as f:
-                return f.read()
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
+        start_time = time.time()
+        wav_data = self.offload_audio(self.render_pattern, text, voice_id, model, key)
         
+        # Cache the audio for future use
+        self.cache.put(key, wav_data, cost=time.time() - start_time,
+                       engine=self.name, voice=voice_id, model=model)
+        
+        return wav_data
+    
+    def render_pattern(self, text, voice_id, model, seed, allocate=bytearray):
+        """Render the pattern WAV for text into a buffer from allocate(size).
+        
+        Runs in a synthesis process when there is a pool (see offload_audio()).
+        """
         # Set parameters based on voice and model
         if voice_id.startswith("female"):
             base_freq = 280  # Female voice range
@@ -184,11 +183,14 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
         
         # Create audio parameters
         sample_rate = 22050
+        pause_samples = int(0.5 * pause_factor * sample_rate)
         
-        # Create an empty audio buffer
-        all_audio = np.array([], dtype=np.float32)
+        # Sentence timing jitter is seeded from the cache key, so the same
+        # request always renders the same audio
+        rng = random.Random(seed)
         
-        # Process each sentence
+        # Lay out every sentence first so the whole output buffer is allocated once
+        layout = []
         for sentence in sentences:
             words = [w for w in sentence.split() if w]
             if not words:
@@ -200,7 +202,7 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             duration = (word_count / words_per_min) * 60
             
             # Add some randomness to make it sound more natural
-            duration *= random.uniform(0.9, 1.1)
+            duration *= rng.uniform(0.9, 1.1)
             
             # Make sure it's not too short
             duration = max(duration, 0.5)
@@ -208,121 +210,108 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             # Make sure it's not too long
             duration = min(duration, 10)
             
-            # Generate time array
-            time_array = np.linspace(0, duration, int(sample_rate * duration), False)
-            
-            # Create a sentence pattern
-            sentence_audio = np.zeros_like(time_array)
-            
-            # Add word patterns
-            word_time = 0
-            for word in words:
-                # Word length affects pattern
-                word_len = len(word)
-                
-                # Calculate word duration based on length and speaking rate
-                word_duration = (word_len / 5) * (60 / words_per_min)
-                word_duration = max(word_duration, 0.1)  # Minimum 100ms per word
-                
-                # Calculate samples for this word
-                word_samples = int(word_duration * sample_rate)
-                
-                # Calculate which portion of the main array this word occupies
-                start_idx = int(word_time * sample_rate)
-                end_idx = min(start_idx + word_samples, len(time_array))
-                
-                if start_idx >= len(time_array) or start_idx >= end_idx:
-                    break
-                
-                # Calculate a frequency shift based on the first letter
-                first_char = word[0].lower() if word else 'a'
-                freq_shift = (ord(first_char) - ord('a')) / 26.0
-                freq_shift = freq_shift * 0.5 + 0.75  # Map to range 0.75 - 1.25
-                
-                # Initialize word pattern
-                word_pattern = np.zeros(end_idx - start_idx)
-                
-                # Generate different pattern based on word length
-                if word_len <= 2:  # Short words
-                    # Single tone with slight frequency modulation
-                    t = np.linspace(0, word_duration, end_idx - start_idx, False)
-                    mod = 1.0 + 0.05 * np.sin(2 * np.pi * 2.0 * t)
-                    word_pattern = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * mod * t)
-                    
-                elif word_len <= 5:  # Medium words
-                    # Two-tone pattern
-                    t = np.linspace(0, word_duration, end_idx - start_idx, False)
-                    # First half of the word
-                    half = (end_idx - start_idx) // 2
-                    word_pattern[:half] = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * t[:half])
-                    # Second half slightly higher
-                    word_pattern[half:] = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * 1.2 * t[half:])
-                    
-                else:  # Long words
-                    # Multi-tone pattern
-                    t = np.linspace(0, word_duration, end_idx - start_idx, False)
-                    # Split into three parts
-                    third = (end_idx - start_idx) // 3
-                    # First third - base tone
-                    word_pattern[:third] = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * t[:third])
-                    # Middle third - slightly higher
-                    word_pattern[third:2*third] = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * 1.2 * t[third:2*third])
-                    # Last third - back to base with vibrato
-                    vib = 1.0 + 0.1 * np.sin(2 * np.pi * 5.0 * t[2*third:])
-                    word_pattern[2*third:] = 0.7 * np.sin(2 * np.pi * base_freq * freq_shift * vib * t[2*third:])
-                
-                # Apply amplitude envelope (attack/decay)
-                envelope = np.ones_like(word_pattern)
-                attack_time = min(int(0.1 * len(envelope)), len(envelope) // 4)
-                decay_time = min(int(0.2 * len(envelope)), len(envelope) // 3)
-                
-                # Attack
-                if attack_time > 0:
-                    envelope[:attack_time] = np.linspace(0, 1, attack_time)
-                
-                # Decay
-                if decay_time > 0 and len(envelope) > decay_time:
-                    envelope[-decay_time:] = np.linspace(1, 0, decay_time)
-                
-                # Apply envelope
-                word_pattern *= envelope
-                
-                # Add to sentence audio
-                sentence_audio[start_idx:end_idx] += word_pattern
-                
-                # Update word time with a small gap between words
-                word_time += word_duration + (0.15 * pause_factor)
-            
-            # Add a pause at the end of the sentence
-            sentence_pause = np.zeros(int(0.5 * pause_factor * sample_rate))
-            
-            # Append sentence audio and pause to the main audio
-            all_audio = np.append(all_audio, sentence_audio)
-            all_audio = np.append(all_audio, sentence_pause)
+            layout.append((words, int(sample_rate * duration)))
+        
+        # Each sentence is followed by a pause of silence
+        total_samples = sum(num_samples + pause_samples for _, num_samples in layout)
+        all_audio = np.zeros(total_samples, dtype=np.float32)
+        
+        offset = 0
+        for words, num_samples in layout:
+            self.render_sentence(all_audio[offset:offset + num_samples], words, base_freq, words_per_min, pause_factor, sample_rate)
+            offset += num_samples + pause_samples
         
         # Normalize audio to prevent clipping
         if len(all_audio) > 0:
-            all_audio = all_audio / (np.max(np.abs(all_audio)) + 1e-6) * 0.9
+            peak = max(all_audio.max(), -all_audio.min())
+            all_audio *= 0.9 / (peak + 1e-6)
         
-        # Convert to 16-bit PCM
-        audio_int16 = (all_audio * 32767).astype(np.int16)
+        # Convert to 16-bit PCM directly behind the WAV header, without intermediate copies
+        wav_buffer = allocate(44 + 2 * len(all_audio))
+        wav_buffer[:44] = wav_header(1, 2, sample_rate, data_size=2 * len(all_audio))
+        pcm = np.frombuffer(wav_buffer, dtype=np.int16, offset=44)
+        all_audio *= 32767
+        pcm[:] = all_audio
+        del all_audio, pcm
         
-        # Create WAV file in memory
-        buffer = io.BytesIO()
-        with wave.open(buffer, 'wb') as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)
-            wf.setframerate(sample_rate)
-            wf.writeframes(audio_int16.tobytes())
+        return wav_buffer
+    
+    def render_sentence(self, out, words, base_freq, words_per_min, pause_factor, sample_rate):
+        """Write the word patterns of one sentence into out (a float32 view of the output)."""
+        num_samples = len(out)
+        
+        word_time = 0
+        for word in words:
+            # Word length affects pattern
+            word_len = len(word)
+            
+            # Calculate word duration based on length and speaking rate
+            word_duration = (word_len / 5) * (60 / words_per_min)
+            word_duration = max(word_duration, 0.1)  # Minimum 100ms per word
+            
+            # Calculate which portion of the sentence this word occupies
+            start_idx = int(word_time * sample_rate)
+            end_idx = min(start_idx + int(word_duration * sample_rate), num_samples)
+            
+            if start_idx >= num_samples or start_idx >= end_idx:
+                break
+            
+            # Calculate a frequency shift based on the first letter
+            first_char = word[0].lower() if word else 'a'
+            freq = self.oscillators.frequency(base_freq, first_char)
+            
+            # A word's waveform only depends on these, so common words are rendered once
+            word_key = (word_len, freq, word_duration, end_idx - start_idx)
+            cached = self.word_cache.get(word_key)
+            if cached is not None:
+                out[start_idx:end_idx] = np.frombuffer(cached, dtype=np.float32)
+            else:
+                self.render_word(out[start_idx:end_idx], word_len, freq, word_duration)
+                self.word_cache.put(word_key, out[start_idx:end_idx])
+            
+            # Update word time with a small gap between words
+            word_time += word_duration + (0.15 * pause_factor)
+    
+    def render_word(self, out, word_len, freq, word_duration):
+        """Write the pattern of one word into out, reading oscillators from the wavetable bank.
         
-        # Get the WAV data
-        wav_data = buffer.getvalue()
+        Each part of the word is a contiguous slice whose phase advances by a
+        fixed step per sample, scaled by the part's frequency multiplier.
+        """
+        length = len(out)
+        step = word_duration / length  # seconds per sample
+        i = np.arange(length)
+        phase = i * (freq * step)  # phase in cycles at the word's base frequency
+        sine = self.oscillators.sine
+        smooth_sine = self.oscillators.smooth_sine
         
-        # Cache the audio for future use
-        with open(cache_path, 'wb') as f:
-            f.write(wav_data)
+        if word_len <= 2:
+            # Short words: single tone with slight frequency modulation
+            phase *= 1.0 + 0.05 * smooth_sine(i * (2.0 * step))
+            out[:] = sine(phase)
+        elif word_len <= 5:
+            # Medium words: two tones
+            half = length // 2
+            out[:half] = sine(phase[:half])
+            out[half:] = sine(phase[half:] * 1.2)  # Slightly higher
+        else:
+            # Long words: three tones
+            third = length // 3
+            out[:third] = sine(phase[:third])
+            out[third:2 * third] = sine(phase[third:2 * third] * 1.2)  # Higher
+            # Back to base with vibrato
+            vibrato = phase[2 * third:]
+            vibrato *= 1.0 + 0.1 * smooth_sine(i[2 * third:] * (5.0 * step))
+            out[2 * third:] = sine(vibrato)
+        out *= 0.7
         
-        return wav_data
+        # Apply amplitude envelope (attack/decay)
+        attack_samples = min(int(0.1 * length), length // 4)
+        decay_samples = min(int(0.2 * length), length // 3)
+        if attack_samples > 0:
+            out[:attack_samples] *= np.linspace(0, 1, attack_samples)
+        if 0 < decay_samples < length:
+            out[-decay_samples:] *= np.linspace(1, 0, decay_samples)
     
     def generate_simple_tone(self):
         """Generate a simple tone as fallback."""
@@ -354,12 +343,11 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
 
 def run_server():
     """Start the HTTP server."""
-    server_address = ('', PORT)
-    httpd = HTTPServer(server_address, OpenVoiceTTSHandler)
+    server = TTSServer(OpenVoiceTTSEngine(), port=PORT)
     logger.info(f"Starting OpenVoice Pattern TTS server on port {PORT}")
     logger.info(f"Server running at http://localhost:{PORT}")
     try:
-        httpd.serve_forever()
+        server.run()
     except KeyboardInterrupt:
         logger.info("Server stopped")
 
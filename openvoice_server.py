@@ -2,20 +2,23 @@
 """
 Minimal OpenVoice TTS Server for Headroom.
 This provides the OpenVoice TTS server API endpoints without any fallbacks to web TTS or system TTS.
-It generates error tones instead of speech when OpenVoice is not available.
+OpenVoice models are loaded in the background once the server is listening;
+until they are ready (or when OpenVoice is not installed) it generates error
+tones instead of speech.
 """
 
 import os
 import sys
-import json
 import time
 import logging
-import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from tts_core import FallbackAudio, TTSEngine, TTSServer
+from tts_cache import AudioCache, cache_name
+from tts_audio import wav_header
 import io
-import hashlib
+import queue
 import threading
 import re
+from concurrent.futures import Future
 
 # Set up logging
 logging.basicConfig(
@@ -27,144 +30,449 @@ logger = logging.getLogger("openvoice")
 # Constants
 PORT = 8008
 CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+audio_cache = AudioCache(CACHE_DIR)
 
 # Import needed libraries
 import wave
-import struct
 import math
-# No numpy dependency
-
-# Flag indicating OpenVoice is not available (we're generating error tones)
-OPENVOICE_AVAILABLE = False
-logger.warning("OpenVoice models not available - synthesizing error tones instead")
-
-class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
-    # Handle CORS preflight requests
-    def do_OPTIONS(self):
-        logger.info("Handling OPTIONS request (CORS preflight)")
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '86400')  # 24 hours
-        self.end_headers()
-    
-    def send_cors_headers(self):
-        """Add CORS headers to response."""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-    
-    def do_GET(self):
-        if self.path == "/health":
-            logger.info("Health check request received")
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                "status": "ok", 
-                "engine": "openvoice", 
-                "available": False
-            }).encode())
-        
-        elif self.path == "/voices":
-            logger.info("Voices request received")
-            voices = self.get_voices()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"voices": voices}).encode())
-        
-        elif self.path == "/models":
-            logger.info("Models request received")
-            models = [
-                {"id": "default", "name": "Default", "status": "unavailable"},
-                {"id": "clear", "name": "Clear Speech", "status": "unavailable"},
-                {"id": "expressive", "name": "Expressive", "status": "unavailable"}
-            ]
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"models": models}).encode())
-        
-        else:
-            logger.warning(f"Unknown GET request for path: {self.path}")
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+import functools
+from array import array
+# numpy is optional; tones are built from a precomputed sine table without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# OpenVoice checkout and checkpoints (see download_openvoice_models.sh)
+OPENVOICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "OpenVoice")
+MODEL_DIR = os.environ.get("OPENVOICE_MODEL_DIR", os.path.join(OPENVOICE_DIR, "resources", "pretrained"))
+OPENVOICE_DEVICE = os.environ.get("OPENVOICE_DEVICE", "cpu")
+# Reference recordings (<voice id>.wav/.mp3/.flac) that give each catalog voice its tone color
+VOICE_DIR = os.environ.get("OPENVOICE_VOICE_DIR", os.path.join(MODEL_DIR, "voices"))
+EMBEDDING_DIR = os.path.join(MODEL_DIR, "speaker_embeddings")
+# Micro-batching of base speaker inference: wait up to this long for more requests
+OPENVOICE_BATCH_WINDOW_MS = float(os.environ.get("OPENVOICE_BATCH_WINDOW_MS", "10"))
+OPENVOICE_BATCH_MAX = int(os.environ.get("OPENVOICE_BATCH_MAX", "8"))
+
+# Voice catalog served by /voices
+VOICES = [
+    {"id": "default", "name": "Default Female", "language": "en-US", "gender": "female"},
+    {"id": "male", "name": "Default Male", "language": "en-US", "gender": "male"},
+    {"id": "emma", "name": "Emma", "language": "en-US", "gender": "female"},
+    {"id": "ryan", "name": "Ryan", "language": "en-US", "gender": "male"},
+    {"id": "olivia", "name": "Olivia", "language": "en-GB", "gender": "female"},
+    {"id": "thomas", "name": "Thomas", "language": "en-GB", "gender": "male"}
+]
+
+# Base speaker style and speed for each model
+MODEL_STYLES = {
+    "default": ("default", 1.0),
+    "clear": ("friendly", 0.85),
+    "expressive": ("cheerful", 1.1),
+}
+
+def encode_wav(audio, sample_rate):
+    """Encode float samples in [-1, 1] as a 16-bit mono WAV."""
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    return wav_header(1, 2, sample_rate, data_size=len(pcm)) + pcm
+
+class Histogram:
+    """Counts of observed values per bucket; each bound is the upper edge of a bucket."""
     
-    def get_voices(self):
-        """Return available OpenVoice voice options (all marked as unavailable)."""
-        voice_list = [
-            {"id": "default", "name": "Default Female", "language": "en-US", "gender": "female", "status": "unavailable"},
-            {"id": "male", "name": "Default Male", "language": "en-US", "gender": "male", "status": "unavailable"},
-            {"id": "emma", "name": "Emma", "language": "en-US", "gender": "female", "status": "unavailable"},
-            {"id": "ryan", "name": "Ryan", "language": "en-US", "gender": "male", "status": "unavailable"},
-            {"id": "olivia", "name": "Olivia", "language": "en-GB", "gender": "female", "status": "unavailable"},
-            {"id": "thomas", "name": "Thomas", "language": "en-GB", "gender": "male", "status": "unavailable"}
-        ]
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+    
+    def as_dict(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        mean = self.sum / self.total if self.total else 0.0
+        return {"count": self.total, "mean": round(mean, 2), "buckets": buckets}
+
+class InferenceBatcher:
+    """Runs concurrent base speaker inferences as padded batches.
+    
+    Requests are collected for up to OPENVOICE_BATCH_WINDOW_MS after the first
+    one arrives, or until OPENVOICE_BATCH_MAX are waiting. Requests with the
+    same speed (VITS takes one length scale per batch) are padded to the
+    longest text, run through the model in one forward pass and cut back to
+    their own lengths. Batch sizes and queue waits are kept as histograms.
+    """
+    
+    def __init__(self, models, window_ms=OPENVOICE_BATCH_WINDOW_MS, max_batch=OPENVOICE_BATCH_MAX):
+        self.models = models
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.queue = queue.Queue()
+        self.batch_sizes = Histogram((1, 2, 4, 8, 16, 32))
+        self.queue_waits = Histogram((1, 2, 5, 10, 20, 50, 100, 250, 1000))  # milliseconds
+        self.thread = None
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="openvoice-batcher", daemon=True)
+            self.thread.start()
+    
+    def submit(self, tokens, speaker_id, speed):
+        """Queue one text piece; returns a Future for its float samples."""
+        future = Future()
+        self.queue.put((tokens, speaker_id, speed, time.perf_counter(), future))
+        return future
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = batch[0][3] + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+            for speed, items in groups.items():
+                self.infer(speed, items)
+    
+    def infer(self, speed, items):
+        import torch
+        now = time.perf_counter()
+        for item in items:
+            self.queue_waits.observe((now - item[3]) * 1000)
+        self.batch_sizes.observe(len(items))
         
-        logger.info(f"Returning {len(voice_list)} unavailable OpenVoice voices")
-        return voice_list
+        try:
+            lengths = torch.LongTensor([item[0].size(0) for item in items])
+            tokens = torch.zeros(len(items), int(lengths.max()), dtype=torch.long)
+            for row, item in enumerate(items):
+                tokens[row, :item[0].size(0)] = item[0]
+            speaker_ids = torch.LongTensor([item[1] for item in items])
+            
+            device = self.models.device
+            with torch.no_grad():
+                audio, _, y_mask, _ = self.models.base.model.infer(
+                    tokens.to(device), lengths.to(device), sid=speaker_ids.to(device),
+                    noise_scale=0.667, noise_scale_w=0.6, length_scale=1.0 / speed)
+            
+            hop_length = self.models.base.hps.data.hop_length
+            audio_lengths = (y_mask.sum(dim=(1, 2)) * hop_length).long().tolist()
+            audio = audio[:, 0].data.cpu().float().numpy()
+            for row, item in enumerate(items):
+                item[4].set_result(audio[row, :audio_lengths[row]])
+        except Exception as e:
+            for item in items:
+                if not item[4].done():
+                    item[4].set_exception(e)
+    
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batch_size": self.batch_sizes.as_dict(),
+            "queue_wait_ms": self.queue_waits.as_dict(),
+        }
+
+class SpeakerEmbeddings:
+    """Tone color embeddings for the voice catalog and the base speaker styles.
+    
+    Each embedding is extracted once, saved next to the checkpoints in
+    speaker_embeddings/ and kept in memory, so switching voices costs nothing
+    beyond the tone color conversion itself. A voice embedding is extracted
+    again when its reference recording is newer than the saved file.
+    """
     
-    def do_POST(self):
-        if self.path == "/tts":
+    def __init__(self, embedding_dir=EMBEDDING_DIR, voice_dir=VOICE_DIR):
+        self.embedding_dir = embedding_dir
+        self.voice_dir = voice_dir
+        self.targets = {}  # voice id -> embedding
+        self.sources = {}  # base speaker style -> embedding
+    
+    def reference_path(self, voice_id):
+        for extension in (".wav", ".mp3", ".flac"):
+            path = os.path.join(self.voice_dir, voice_id + extension)
+            if os.path.exists(path):
+                return path
+        return None
+    
+    def load(self, models):
+        """Load or extract every embedding; called by the model loader thread."""
+        import torch
+        os.makedirs(self.embedding_dir, exist_ok=True)
+        
+        def load_or_extract(name, source_mtime, extract):
+            path = os.path.join(self.embedding_dir, name + ".pth")
+            if os.path.exists(path) and os.path.getmtime(path) >= source_mtime:
+                return torch.load(path, map_location=models.device)
+            start_time = time.time()
+            embedding = extract()
+            tmp_path = path + ".tmp"
+            torch.save(embedding.cpu(), tmp_path)
+            os.replace(tmp_path, path)
+            logger.info(f"Extracted speaker embedding '{name}' in {time.time() - start_time:.1f}s")
+            return embedding
+        
+        # Base speaker styles: OpenVoice ships embeddings for the default and the other styles
+        base_dir = os.path.join(models.model_dir, "base_speakers", "EN")
+        for speaker, _ in MODEL_STYLES.values():
+            shipped = os.path.join(base_dir, "en_default_se.pth" if speaker == "default" else "en_style_se.pth")
+            if os.path.exists(shipped):
+                self.sources[speaker] = torch.load(shipped, map_location=models.device)
+                continue
+            def extract_base(speaker=speaker):
+                sample = models.base.tts("The quick brown fox jumps over the lazy dog. How are you today?",
+                                         None, speaker=speaker, language="English")
+                return models.converter.extract_se([io.BytesIO(encode_wav(sample, models.sample_rate))])
+            self.sources[speaker] = load_or_extract(f"base_{speaker}", 0, extract_base)
+        
+        # Catalog voices with a reference recording
+        for voice in VOICES:
+            reference = self.reference_path(voice["id"])
+            if reference is None:
+                continue
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                request = json.loads(post_data.decode())
-                text = request.get("text", "")
-                voice_id = request.get("speaker", "default")
-                model = request.get("model", "default")
-                
-                logger.info(f"TTS request: text='{text[:50]}...', voice='{voice_id}', model='{model}'")
-                
-                # Generate error tone instead of speech
-                audio_data = self.generate_error_tone(text, voice_id, model)
-                
-                # Return audio
-                self.send_response(200)
-                self.send_header('Content-type', 'audio/wav')
-                self.send_header('Content-Length', str(len(audio_data)))
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(audio_data)
-                
-                logger.info(f"Error tone response sent: {len(audio_data)} bytes")
-                
+                self.targets[voice["id"]] = load_or_extract(
+                    voice["id"], os.path.getmtime(reference),
+                    lambda reference=reference: models.converter.extract_se([reference]))
             except Exception as e:
-                logger.error(f"Error handling TTS request: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.send_cors_headers()
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+                logger.error(f"Could not extract speaker embedding for voice '{voice['id']}': {e}")
+        logger.info(f"Speaker embeddings ready for voices: {sorted(self.targets) or 'none'}")
+    
+    def source(self, speaker):
+        return self.sources.get(speaker)
+    
+    def target(self, voice_id):
+        """Embedding for voice_id, or None when the voice has no reference recording."""
+        return self.targets.get(voice_id)
+
+class OpenVoiceModels:
+    """OpenVoice checkpoints, loaded once in a background thread and kept resident.
+    
+    state is "loading" until the models are usable, then "ready"; it becomes
+    "unavailable" when OpenVoice or its checkpoints are missing.
+    """
+    
+    def __init__(self, model_dir=MODEL_DIR, device=OPENVOICE_DEVICE):
+        self.model_dir = model_dir
+        self.device = device
+        self.state = "loading"
+        self.error = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.base = None  # BaseSpeakerTTS
+        self.converter = None  # ToneColorConverter
+        self.embeddings = SpeakerEmbeddings()
+        self.batcher = InferenceBatcher(self)
+        self.sample_rate = None
+        self.lock = threading.Lock()  # one tone color conversion at a time; torch uses all cores for each
+        self.loader = None
+    
+    @property
+    def ready(self):
+        return self.state == "ready"
+    
+    def start(self):
+        """Start loading the models in the background."""
+        if self.loader is None:
+            self.loader = threading.Thread(target=self.load, name="openvoice-loader", daemon=True)
+            self.loader.start()
+    
+    def load(self):
+        start_time = time.time()
+        try:
+            base_config = os.path.join(self.model_dir, "base_speakers", "EN", "config.json")
+            base_ckpt = os.path.join(self.model_dir, "base_speakers", "EN", "best_model.pth")
+            converter_config = os.path.join(self.model_dir, "converter", "config.json")
+            converter_ckpt = os.path.join(self.model_dir, "converter", "best_model.pth")
+            for path in (base_config, base_ckpt, converter_config, converter_ckpt):
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"Model file not found: {path} (run download_openvoice_models.sh)")
+            
+            if os.path.isdir(OPENVOICE_DIR) and OPENVOICE_DIR not in sys.path:
+                sys.path.append(OPENVOICE_DIR)
+            from openvoice.api import BaseSpeakerTTS, ToneColorConverter
+            
+            logger.info(f"Loading OpenVoice models on {self.device}...")
+            base = BaseSpeakerTTS(base_config, device=self.device)
+            base.load_ckpt(base_ckpt)
+            converter = ToneColorConverter(converter_config, device=self.device, enable_watermark=False)
+            converter.load_ckpt(converter_ckpt)
+            
+            self.base = base
+            self.converter = converter
+            self.sample_rate = base.hps.data.sampling_rate
+            self.embeddings.load(self)
+            self.batcher.start()
+            self.memory_bytes = sum(param.numel() * param.element_size()
+                                    for model in (base.model, converter.model)
+                                    for param in model.parameters())
+            self.load_seconds = time.time() - start_time
+            self.state = "ready"
+            logger.info(f"OpenVoice models ready in {self.load_seconds:.1f}s "
+                        f"({self.memory_bytes / 1024 / 1024:.0f} MB of weights)")
+        except Exception as e:
+            self.error = str(e)
+            self.load_seconds = time.time() - start_time
+            self.state = "unavailable"
+            logger.warning(f"OpenVoice models not available - synthesizing error tones instead: {e}")
+    
+    def status(self):
+        """Loading state for /health."""
+        status = {"state": self.state, "device": self.device}
+        if self.load_seconds is not None:
+            status["load_seconds"] = round(self.load_seconds, 2)
+        if self.memory_bytes is not None:
+            status["memory_bytes"] = self.memory_bytes
+        if self.ready:
+            status["voices_with_embeddings"] = sorted(self.embeddings.targets)
+            status["batching"] = self.batcher.stats()
+        if self.error is not None:
+            status["error"] = self.error
+        try:
+            import resource
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            status["peak_rss_bytes"] = peak_rss if sys.platform == "darwin" else peak_rss * 1024
+        except ImportError:
+            pass
+        return status
+
+openvoice_models = OpenVoiceModels()
+
+class OpenVoiceTTSEngine(TTSEngine):
+    """OpenVoice engine served by the shared TTS server core, with error tones while it is not ready."""
+
+    name = "openvoice"
+    cache = audio_cache
+    models = openvoice_models
+
+    def health(self):
+        """Report whether OpenVoice is loading, ready or unavailable."""
+        return {
+            "status": "ok", 
+            "engine": "openvoice", 
+            "available": self.models.ready,
+            "models": self.models.status()
+        }
+
+    def start(self):
+        """Load the OpenVoice models in the background once the server is listening."""
+        self.models.start()
+
+    def get_models(self):
+        """Return OpenVoice models with their loading state."""
+        status = "ready" if self.models.ready else self.models.state
+        return [
+            {"id": "default", "name": "Default", "status": status},
+            {"id": "clear", "name": "Clear Speech", "status": status},
+            {"id": "expressive", "name": "Expressive", "status": status}
+        ]
+    
+    def voices_version(self):
+        """The voice list reports the loading state, so it changes with it."""
+        return self.models.state
+
+    def get_voices(self):
+        """Return available OpenVoice voice options with their loading state."""
+        status = "ready" if self.models.ready else self.models.state
+        voice_list = [dict(voice, status=status) for voice in VOICES]
+        
+        logger.info(f"Returning {len(voice_list)} {status} OpenVoice voices")
+        return voice_list
+    
+    def synthesize(self, text, voice_id, model):
+        """Generate speech with OpenVoice, or an error tone while it is not ready."""
+        if self.models.ready:
+            return self.generate_speech(text, voice_id, model)
+        return FallbackAudio(self.generate_error_tone(text, voice_id, model))
+    
+    def generate_speech(self, text, voice_id, model):
+        """Generate speech with the resident OpenVoice models.
+        
+        The base speaker model speaks the text (see base_speech()); voices with a
+        speaker embedding are then given their tone color by the converter.
+        """
+        # "speech" keeps these apart from error tones cached under the plain key by older versions
+        key = cache_name(self.name, "wav", text, voice_id, model, "speech")
+        
+        # Return cached audio if available
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info(f"Using cached speech for: '{text[:30]}...'")
+            return cached
+        
+        start_time = time.time()
+        speaker, speed = MODEL_STYLES.get(model, MODEL_STYLES["default"])
+        base_audio = self.base_speech(text, speaker, speed)
+        target = self.models.embeddings.target(voice_id)
+        if target is None:
+            return base_audio
+        
+        with self.models.lock:
+            audio = self.models.converter.convert(
+                audio_src_path=io.BytesIO(base_audio),
+                src_se=self.models.embeddings.source(speaker), tgt_se=target, output_path=None)
+        audio_data = encode_wav(audio, self.models.converter.hps.data.sampling_rate)
+        
+        self.cache.put(key, audio_data, cost=time.time() - start_time,
+                       engine=self.name, voice=voice_id, model=model)
+        return audio_data
+    
+    def base_speech(self, text, speaker, speed, language="English"):
+        """Base speaker output for text, cached independently of the voice.
+        
+        The same sentence requested in another voice only needs the tone color
+        conversion, not another pass through the base speaker model.
+        """
+        key = cache_name("openvoice-base", "wav", text, language, speaker, speed)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
+        start_time = time.time()
+        # Same preprocessing as BaseSpeakerTTS.tts(), with inference left to the batcher
+        base = self.models.base
+        mark = base.language_marks.get(language.lower())
+        speaker_id = base.hps.speakers[speaker]
+        pieces = []
+        for piece in base.split_sentences_into_pieces(text, language):
+            piece = re.sub(r'([a-z])([A-Z])', r'\1 \2', piece)
+            tokens = base.get_text(f'[{mark}]{piece}[{mark}]', base.hps, False)
+            pieces.append(self.models.batcher.submit(tokens, speaker_id, speed))
+        audio = base.audio_numpy_concat([piece.result() for piece in pieces],
+                                        sr=self.models.sample_rate, speed=speed)
+        audio_data = encode_wav(audio, self.models.sample_rate)
+        
+        self.cache.put(key, audio_data, cost=time.time() - start_time,
+                       engine="openvoice-base", voice=speaker, model=f"{language}@{speed}")
+        return audio_data
     
     def generate_error_tone(self, text, voice_id, model):
         """Generate different error tones based on input parameters."""
         logger.info(f"Generating error tone for: '{text[:50]}...', voice: {voice_id}, model: {model}")
         
-        # Create a cache key
-        cache_key = hashlib.md5(f"{text}_{voice_id}_{model}_error_tone".encode()).hexdigest()
-        cache_path = os.path.join(CACHE_DIR, f"{cache_key}.wav")
+        # Create a cache key; tones have their own namespace so they are never served as speech
+        key = cache_name("openvoice-tone", "wav", text, voice_id, model)
         
         # Return cached audio if available
-        if os.path.exists(cache_path):
+        cached = self.cache.get(key)
+        if cached is not None:
             logger.info(f"Using cached error tone for: '{text[:30]}...'")
-            with open(cache_path, 'rb') as f:
-                return f.read()
+            return cached
+        
+        start_time = time.time()
         
         try:
             # Different frequency tones based on voice (to simulate different voices)
@@ -185,12 +493,7 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             num_samples = int(duration * sample_rate)
             
             # Generate samples - simple sine wave
-            samples = []
-            for i in range(num_samples):
-                # Add slight decay to avoid clicks
-                amplitude = 32767 * 0.3 * (1.0 - i / num_samples)  
-                sample = amplitude * math.sin(2 * math.pi * frequency * i / sample_rate)
-                samples.append(int(sample))
+            pcm = tone_pcm(frequency, num_samples, sample_rate)
             
             # Create WAV file in memory
             buffer = io.BytesIO()
@@ -198,14 +501,13 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
                 wf.setnchannels(1)
                 wf.setsampwidth(2)  # 16-bit
                 wf.setframerate(sample_rate)
-                for sample in samples:
-                    wf.writeframes(struct.pack('<h', sample))
+                wf.writeframes(pcm)
             
             audio_data = buffer.getvalue()
             
             # Cache the audio
-            with open(cache_path, 'wb') as f:
-                f.write(audio_data)
+            self.cache.put(key, audio_data, cost=time.time() - start_time,
+                           engine="openvoice-tone", voice=voice_id, model=model)
             
             return audio_data
             
@@ -231,14 +533,59 @@ class OpenVoiceTTSHandler(BaseHTTPRequestHandler):
             silence = bytes(3200)  # 1600 samples of silence (16-bit samples = 3200 bytes)
             return header + silence
 
+@functools.lru_cache(maxsize=32)
+def sine_table(frequency, sample_rate):
+    """One exact period of a sine wave sampled at sample_rate.
+    
+    The period is the smallest number of samples after which the sampled wave
+    repeats (e.g. 200 samples, i.e. 11 cycles, for 440 Hz at 16 kHz).
+    """
+    period = sample_rate // math.gcd(int(frequency), sample_rate)
+    return [math.sin(2 * math.pi * frequency * i / sample_rate) for i in range(period)]
+
+# Every error tone generate_error_tone can produce: (frequency, duration)
+ERROR_TONE_RATE = 16000
+ERROR_TONES = [(frequency, duration) for frequency in (440, 220) for duration in (0.3, 0.5, 0.2)]
+
+def render_tone(frequency, num_samples, sample_rate):
+    """Return little-endian 16-bit PCM for a sine tone with a linear decay."""
+    # Add slight decay to avoid clicks
+    if np is not None:
+        i = np.arange(num_samples)
+        amplitude = 32767 * 0.3 * (1.0 - i / num_samples)
+        samples = amplitude * np.sin(2 * np.pi * frequency * i / sample_rate)
+        return samples.astype('<i2').tobytes()
+    
+    table = sine_table(frequency, sample_rate)
+    period = len(table)
+    scale = 32767 * 0.3
+    samples = array('h', [int(scale * (1.0 - i / num_samples) * table[i % period])
+                          for i in range(num_samples)])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+@functools.lru_cache(maxsize=1)
+def error_tone_blocks():
+    """PCM for all error tones, rendered together on first use (a few ms without numpy)."""
+    return {(frequency, int(duration * ERROR_TONE_RATE), ERROR_TONE_RATE):
+            render_tone(frequency, int(duration * ERROR_TONE_RATE), ERROR_TONE_RATE)
+            for frequency, duration in ERROR_TONES}
+
+def tone_pcm(frequency, num_samples, sample_rate):
+    """Return the PCM of a tone, from the prebuilt error tones when it is one of them."""
+    block = error_tone_blocks().get((frequency, num_samples, sample_rate))
+    if block is None:
+        block = render_tone(frequency, num_samples, sample_rate)
+    return block
+
 def run_server():
     """Start the HTTP server."""
-    server_address = ('', PORT)
-    httpd = HTTPServer(server_address, OpenVoiceTTSHandler)
+    server = TTSServer(OpenVoiceTTSEngine(), port=PORT)
     logger.info(f"Starting OpenVoice TTS server on port {PORT}")
     logger.info(f"Server running at http://localhost:{PORT}")
     try:
-        httpd.serve_forever()
+        server.run()
     except KeyboardInterrupt:
         logger.info("Server stopped")
 
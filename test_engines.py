@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Tests for the speech engines of the Headroom TTS servers.
+Engines are tested in-process with local stand-ins for any upstream service,
+so no model, API key or network access is needed. Needs the servers'
+dependencies (numpy, requests, gTTS).
+
+Usage: python3 test_engines.py [-v]
+"""
+
+import re
+import json
+import math
+import os
+import base64
+import random
+import threading
+import urllib.parse
+import tempfile
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("TTS_CACHE_SWEEP_INTERVAL", "0")
+
+import numpy as np
+import requests
+import gtts.tts
+
+import elevenlabs_openvoice_server
+import local_tts_server
+import minimal_openvoice_server
+import openvoice_server
+from elevenlabs_openvoice_server import ElevenLabsClient
+from elevenlabs_standin import StandInServer, fake_audio
+from tts_audio import read_wav
+from tts_cache import AudioCache, MemoryLRU
+
+
+def reference_pattern(text, voice_id, model, rng):
+    """The pattern renderer as it was before the rewrite: float64, np.sin and np.append per sentence."""
+    base_freq = 280 if voice_id.startswith("female") else 150
+    if voice_id.endswith("_2"):
+        base_freq *= 1.1
+    words_per_min, pause_factor = {"slow": (100, 1.5), "fast": (180, 0.7)}.get(model, (140, 1.0))
+    sentences = [s.strip() for s in text.replace("?", ".").replace("!", ".").split(".") if s.strip()] or [text]
+    sample_rate = 22050
+    all_audio = np.array([], dtype=np.float32)
+    for sentence in sentences:
+        words = [w for w in sentence.split() if w]
+        if not words:
+            continue
+        duration = min(max((len(words) / words_per_min) * 60 * rng.uniform(0.9, 1.1), 0.5), 10)
+        time_array = np.linspace(0, duration, int(sample_rate * duration), False)
+        sentence_audio = np.zeros_like(time_array)
+        word_time = 0
+        for word in words:
+            word_len = len(word)
+            word_duration = max((word_len / 5) * (60 / words_per_min), 0.1)
+            start_idx = int(word_time * sample_rate)
+            end_idx = min(start_idx + int(word_duration * sample_rate), len(time_array))
+            if start_idx >= len(time_array) or start_idx >= end_idx:
+                break
+            freq = base_freq * (((ord(word[0].lower()) - ord("a")) / 26.0) * 0.5 + 0.75)
+            t = np.linspace(0, word_duration, end_idx - start_idx, False)
+            pattern = np.zeros(end_idx - start_idx)
+            if word_len <= 2:
+                pattern = 0.7 * np.sin(2 * np.pi * freq * (1.0 + 0.05 * np.sin(2 * np.pi * 2.0 * t)) * t)
+            elif word_len <= 5:
+                half = len(t) // 2
+                pattern[:half] = 0.7 * np.sin(2 * np.pi * freq * t[:half])
+                pattern[half:] = 0.7 * np.sin(2 * np.pi * freq * 1.2 * t[half:])
+            else:
+                third = len(t) // 3
+                pattern[:third] = 0.7 * np.sin(2 * np.pi * freq * t[:third])
+                pattern[third:2 * third] = 0.7 * np.sin(2 * np.pi * freq * 1.2 * t[third:2 * third])
+                vibrato = 1.0 + 0.1 * np.sin(2 * np.pi * 5.0 * t[2 * third:])
+                pattern[2 * third:] = 0.7 * np.sin(2 * np.pi * freq * vibrato * t[2 * third:])
+            envelope = np.ones_like(pattern)
+            attack = min(int(0.1 * len(envelope)), len(envelope) // 4)
+            decay = min(int(0.2 * len(envelope)), len(envelope) // 3)
+            if attack > 0:
+                envelope[:attack] = np.linspace(0, 1, attack)
+            if decay > 0 and len(envelope) > decay:
+                envelope[-decay:] = np.linspace(1, 0, decay)
+            sentence_audio[start_idx:end_idx] += pattern * envelope
+            word_time += word_duration + (0.15 * pause_factor)
+        all_audio = np.append(all_audio, sentence_audio)
+        all_audio = np.append(all_audio, np.zeros(int(0.5 * pause_factor * sample_rate)))
+    if len(all_audio) > 0:
+        all_audio = all_audio / (np.max(np.abs(all_audio)) + 1e-6) * 0.9
+    return (all_audio * 32767).astype(np.int16)
+
+
+PATTERN_TEXTS = [
+    "Hello there, how are you doing today? I am fine. Extraordinary circumstances require a b c!",
+    "The quick brown fox jumps over the lazy dog. " * 20,
+    "Zebra 123 words here.",
+]
+
+
+class PatternEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = minimal_openvoice_server.OpenVoiceTTSEngine()
+
+    def render(self, text, voice_id="default", model="default", seed="seed"):
+        params, frames = read_wav(self.engine.render_pattern(text, voice_id, model, seed))
+        self.assertEqual(params, (1, 2, 22050))
+        return np.frombuffer(frames, dtype=np.int16)
+
+    def test_output_matches_the_original_renderer(self):
+        for voice_id in ("default", "female_2"):
+            for model in ("default", "slow", "fast"):
+                for text in PATTERN_TEXTS:
+                    with self.subTest(voice=voice_id, model=model, text=text[:20]):
+                        expected = reference_pattern(text, voice_id, model, random.Random("seed"))
+                        pcm = self.render(text, voice_id, model)
+                        self.assertEqual(len(pcm), len(expected))
+                        # float32 rendering may round a sample to the neighbouring 16-bit step
+                        self.assertLessEqual(np.abs(pcm.astype(int) - expected).max(), 1)
+
+    def test_output_buffer_is_allocated_once(self):
+        sizes = []
+
+        def allocate(size):
+            sizes.append(size)
+            return bytearray(size)
+
+        wav = self.engine.render_pattern(PATTERN_TEXTS[1], "default", "default", "seed", allocate)
+        self.assertEqual(sizes, [len(wav)])
+
+
+class WordCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = minimal_openvoice_server.OpenVoiceTTSEngine()
+        self.engine.word_cache = MemoryLRU(1 << 20)
+
+    def render(self, text, seed="seed"):
+        return self.engine.render_pattern(text, "default", "default", seed)
+
+    def test_same_seed_renders_the_same_audio(self):
+        first = self.render(PATTERN_TEXTS[0])
+        self.engine.word_cache.clear()
+        self.assertEqual(self.render(PATTERN_TEXTS[0]), first)
+        self.assertNotEqual(self.render(PATTERN_TEXTS[0], seed="other"), first)
+
+    def test_cached_words_render_the_same_audio(self):
+        cold = self.render(PATTERN_TEXTS[1])
+        self.assertTrue(self.engine.word_cache.entries)
+        with mock.patch.object(self.engine, "render_word", wraps=self.engine.render_word) as render_word:
+            warm = self.render(PATTERN_TEXTS[1])
+        self.assertEqual(warm, cold)
+        render_word.assert_not_called()
+
+    def test_repeated_words_are_rendered_once(self):
+        with mock.patch.object(self.engine, "render_word", wraps=self.engine.render_word) as render_word:
+            self.render(PATTERN_TEXTS[1])
+        self.assertEqual(render_word.call_count, len(self.engine.word_cache.entries))
+        self.assertLess(render_word.call_count, len(PATTERN_TEXTS[1].split()))
+
+    def test_word_cache_stays_within_its_budget(self):
+        # The words of the text take about 500 kB
+        self.engine.word_cache = MemoryLRU(100000)
+        cold = self.render(PATTERN_TEXTS[1])
+        self.assertTrue(self.engine.word_cache.entries)
+        self.assertLessEqual(self.engine.word_cache.size, 100000)
+        self.assertEqual(self.engine.word_cache.size, sum(map(len, self.engine.word_cache.entries.values())))
+        self.assertEqual(self.render(PATTERN_TEXTS[1]), cold)
+
+
+class OscillatorBankTest(unittest.TestCase):
+
+    bank = minimal_openvoice_server.oscillators
+    # Phases as the renderer produces them: up to 10 s of a 400 Hz carrier
+    cycles = np.random.default_rng(0).uniform(0, 4000, 100000)
+
+    def test_sine_stays_within_half_a_table_step(self):
+        error = np.abs(self.bank.sine(self.cycles) - np.sin(2 * np.pi * self.cycles)).max()
+        self.assertLessEqual(error, np.pi / self.bank.size + 1e-9)
+        # Well below one 16-bit step at the renderer's full scale
+        self.assertLess(error * 0.9 * 32767, 0.5)
+
+    def test_smooth_sine_is_precise_enough_for_modulators(self):
+        error = np.abs(self.bank.smooth_sine(self.cycles) - np.sin(2 * np.pi * self.cycles)).max()
+        self.assertLess(error, 1e-9)
+
+    def test_frequency_matches_the_letter_formula(self):
+        for base_freq in minimal_openvoice_server.PATTERN_BASE_FREQS + (200,):
+            for char in "az" + "m0?é":
+                with self.subTest(base_freq=base_freq, char=char):
+                    expected = base_freq * (((ord(char) - ord("a")) / 26.0) * 0.5 + 0.75)
+                    self.assertAlmostEqual(self.bank.frequency(base_freq, char), expected, places=9)
+
+
+class ErrorToneTest(unittest.TestCase):
+
+    def setUp(self):
+        openvoice_server.error_tone_blocks.cache_clear()
+        self.addCleanup(openvoice_server.error_tone_blocks.cache_clear)
+
+    def expected(self, frequency, num_samples, sample_rate):
+        """The per-sample formula generate_error_tone used before tones were built in blocks."""
+        return [int(32767 * 0.3 * (1.0 - i / num_samples) * math.sin(2 * math.pi * frequency * i / sample_rate))
+                for i in range(num_samples)]
+
+    def test_tones_match_the_per_sample_formula(self):
+        for numpy in (np, None):
+            with mock.patch.object(openvoice_server, "np", numpy):
+                openvoice_server.error_tone_blocks.cache_clear()
+                for frequency, duration in openvoice_server.ERROR_TONES:
+                    num_samples = int(duration * 16000)
+                    with self.subTest(numpy=numpy is not None, frequency=frequency, duration=duration):
+                        pcm = openvoice_server.tone_pcm(frequency, num_samples, 16000)
+                        samples = np.frombuffer(pcm, dtype="<i2").tolist()
+                        self.assertEqual(samples, self.expected(frequency, num_samples, 16000))
+
+    def test_error_tones_are_built_once(self):
+        with mock.patch.object(openvoice_server, "render_tone", wraps=openvoice_server.render_tone) as render:
+            for _ in range(3):
+                for frequency, duration in openvoice_server.ERROR_TONES:
+                    openvoice_server.tone_pcm(frequency, int(duration * 16000), 16000)
+        self.assertEqual(render.call_count, len(openvoice_server.ERROR_TONES))
+
+    def test_other_tones_are_rendered_on_demand(self):
+        pcm = openvoice_server.tone_pcm(330, 100, 8000)
+        self.assertEqual(np.frombuffer(pcm, dtype="<i2").tolist(), self.expected(330, 100, 8000))
+
+
+class ElevenLabsClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = StandInServer().start()
+        self.addCleanup(self.api.stop)
+        self.client = ElevenLabsClient(self.api.url, "key", max_concurrency=2, retries=2)
+        self.addCleanup(self.client.session.close)
+        sleep = mock.patch.object(elevenlabs_openvoice_server.time, "sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def assertSlotsReleased(self):
+        for _ in range(2):
+            self.assertTrue(self.client.slots.acquire(blocking=False))
+        for _ in range(2):
+            self.client.slots.release()
+
+    def test_rate_limited_calls_are_retried_after_retry_after(self):
+        self.api.fail(429, times=2, retry_after=2)
+        response = self.client.request("POST", "/text-to-speech/v1", json={"text": "Hello."})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, fake_audio("Hello."))
+        self.assertEqual(len(self.api.calls), 3)
+        self.assertEqual(self.sleep.call_args_list, [mock.call(2.0), mock.call(2.0)])
+        self.assertEqual(self.client.stats()["retries"], 2)
+        self.assertEqual(self.client.stats()["failures"], 0)
+        self.assertSlotsReleased()
+
+    def test_server_errors_are_retried_with_capped_backoff(self):
+        self.api.fail(503)
+        response = self.client.request("GET", "/voices")
+        self.assertEqual(response.status_code, 200)
+        (delay,), _ = self.sleep.call_args
+        self.assertLessEqual(delay, elevenlabs_openvoice_server.ELEVENLABS_RETRY_BACKOFF)
+        self.assertEqual(self.client.stats()["failures"], 0)
+
+    def test_failures_are_counted_once_retries_are_used_up(self):
+        self.api.fail(502, times=3)
+        response = self.client.request("GET", "/voices")
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(self.api.calls), 3)
+        self.assertEqual(self.client.stats(), {"url": self.api.url, "requests": 3, "retries": 2, "failures": 1})
+        self.assertSlotsReleased()
+
+    def test_other_errors_are_returned_without_retrying(self):
+        self.api.fail(401)
+        response = self.client.request("GET", "/voices")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(self.api.calls), 1)
+        self.assertEqual(self.client.stats()["failures"], 0)
+        self.assertSlotsReleased()
+
+    def test_connection_errors_are_retried_then_raised(self):
+        closed = StandInServer()
+        closed.server_close()
+        self.client = ElevenLabsClient(closed.url, "key", max_concurrency=2, retries=1)
+        with self.assertRaises(requests.ConnectionError):
+            self.client.request("GET", "/voices")
+        self.assertEqual(self.client.stats()["retries"], 1)
+        self.assertEqual(self.client.stats()["failures"], 1)
+        self.assertSlotsReleased()
+
+    def test_stream_holds_a_slot_until_closed(self):
+        chunks = self.client.stream("POST", "/text-to-speech/v1/stream", json={"text": "Hello there."})
+        self.assertEqual(next(chunks)[:2], b"\xff\xf3")
+        # One of the two slots is taken by the open stream
+        self.assertTrue(self.client.slots.acquire(blocking=False))
+        self.assertFalse(self.client.slots.acquire(blocking=False))
+        self.client.slots.release()
+        chunks.close()
+        self.assertSlotsReleased()
+
+    def test_stream_errors_raise_and_release_the_slot(self):
+        self.api.fail(500, times=3)
+        with self.assertRaises(Exception):
+            list(self.client.stream("POST", "/text-to-speech/v1/stream", json={"text": "Hello."}))
+        self.assertEqual(self.client.stats()["failures"], 1)
+        self.assertSlotsReleased()
+
+    def test_calls_reuse_one_connection(self):
+        for text in ("One.", "Two.", "Three."):
+            response = self.client.request("POST", "/text-to-speech/v1", json={"text": text})
+            self.assertEqual(response.content, fake_audio(text))
+        self.api.fail(503)
+        self.client.request("GET", "/voices")
+        self.assertEqual(len(self.api.calls), 5)
+        self.assertEqual(len(self.api.ports), 1)
+        self.assertTrue(all(api_key == "key" for _, _, api_key, _ in self.api.calls))
+
+
+class ElevenLabsRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = StandInServer().start()
+        self.addCleanup(self.api.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.engine = elevenlabs_openvoice_server.ElevenLabsOpenVoiceTTSEngine()
+        self.engine.client = ElevenLabsClient(self.api.url, "key", max_concurrency=2, retries=0)
+        self.addCleanup(self.engine.client.session.close)
+        self.engine.cache = AudioCache(self.dir, sweep_interval=0)
+        api_key = mock.patch.object(elevenlabs_openvoice_server, "ELEVENLABS_API_KEY", "key")
+        api_key.start()
+        self.addCleanup(api_key.stop)
+
+    def temporary_files(self):
+        return [name for name in os.listdir(self.dir) if name.endswith(".tmp")]
+
+    def test_complete_stream_is_cached(self):
+        text = "A sentence streamed in several chunks."
+        audio = b"".join(self.engine.open_stream(text, "v1", "default"))
+        self.assertEqual(audio, fake_audio(text))
+        self.assertEqual(list(self.engine.open_stream(text, "v1", "default")), [audio])
+        self.assertEqual(len(self.api.calls), 1)
+        self.assertEqual(self.temporary_files(), [])
+
+    def test_abandoned_stream_leaves_nothing_cached(self):
+        text = "A sentence the client hangs up on."
+        chunks = self.engine.open_stream(text, "v1", "default")
+        next(chunks)
+        chunks.close()
+        self.assertEqual(self.engine.cache.select(), [])
+        self.assertEqual(self.temporary_files(), [])
+        self.assertEqual(b"".join(self.engine.open_stream(text, "v1", "default")), fake_audio(text))
+        self.assertEqual(len(self.api.calls), 2)
+        self.assertEqual(len(self.engine.cache.select()), 1)
+
+
+class TranslateStandIn(BaseHTTPRequestHandler):
+    """Answers Google Translate TTS requests with fake MP3 frames made from the piece of text."""
+
+    protocol_version = "HTTP/1.1"
+    pieces = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        rpc = json.loads(urllib.parse.unquote(body[len("f.req="):].rstrip("&")))
+        text = json.loads(rpc[0][0][1])[0]
+        self.pieces.append(text)
+        audio = base64.b64encode(b"\xff\xf3" + text.encode()).decode()
+        reply = (")]}'\n\n123\n" + '[["wrb.fr","jQ1olc","[\\"%s\\"]",null,null,null,"generic"]]' % audio + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class GTTSFetcherTest(unittest.TestCase):
+
+    text = ("Welcome back to Headroom, your next session starts in five minutes, so take a moment to breathe. "
+            "Close any tabs you do not need and press start when you are ready.")
+
+    def setUp(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), TranslateStandIn)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+        TranslateStandIn.pieces = []
+        self.fetcher = local_tts_server.GTTSFetcher(workers=4, base_url=url)
+        self.addCleanup(self.fetcher.pool.shutdown)
+        # gTTS's own requests, for the fallback, go to the stand-in as well
+        translate_url = mock.patch.object(gtts.tts, "_translate_url", lambda tld="com", path="": f"{url}/{path}")
+        translate_url.start()
+        self.addCleanup(translate_url.stop)
+
+    def joined(self, pieces):
+        return b"".join(b"\xff\xf3" + piece.encode() for piece in pieces)
+
+    def test_pieces_are_fetched_concurrently_and_joined_in_order(self):
+        audio = self.fetcher.synthesize(self.text, "en", False)
+        fetched = TranslateStandIn.pieces
+        TranslateStandIn.pieces = []
+        # gTTS's own, sequential fetch of the same text
+        self.assertEqual(audio, self.fetcher.synthesize_with_gtts(gtts.tts.gTTS(self.text)))
+        self.assertGreater(len(fetched), 1)
+        self.assertEqual(sorted(fetched), sorted(TranslateStandIn.pieces))
+        self.assertEqual(audio, self.joined(TranslateStandIn.pieces))
+
+    def test_missing_gtts_helper_falls_back_to_gtts(self):
+        prepare_requests = gtts.tts.gTTS._prepare_requests
+        missing = []
+
+        def prepare_once(tts):
+            # Missing for the fetcher, present for gTTS's own fetch
+            if not missing:
+                missing.append(True)
+                raise AttributeError("_prepare_requests")
+            return prepare_requests(tts)
+
+        with mock.patch.object(gtts.tts.gTTS, "_prepare_requests", prepare_once):
+            audio = self.fetcher.synthesize(self.text, "en", False)
+        self.assertTrue(missing)
+        self.assertGreater(len(TranslateStandIn.pieces), 1)
+        self.assertEqual(audio, self.joined(TranslateStandIn.pieces))
+
+    def test_unrecognized_response_falls_back_to_gtts(self):
+        with mock.patch.object(local_tts_server, "GTTS_AUDIO", re.compile("a format gTTS moved away from")):
+            audio = self.fetcher.synthesize(self.text, "en", False)
+        # Every piece is fetched by the fetcher, then once more by gTTS
+        count = len(TranslateStandIn.pieces) // 2
+        fetched, refetched = TranslateStandIn.pieces[:count], TranslateStandIn.pieces[count:]
+        self.assertEqual(sorted(fetched), sorted(refetched))
+        self.assertEqual(audio, self.joined(refetched))
+
+    def test_tls_certificates_are_verified(self):
+        with mock.patch.object(self.fetcher.session, "send", wraps=self.fetcher.session.send) as send:
+            self.fetcher.synthesize("Hello.", "en", False)
+        _, options = send.call_args
+        self.assertIsNot(options.get("verify", True), False)
+
+
+if __name__ == "__main__":
+    unittest.main()
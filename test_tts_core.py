@@ -0,0 +1,862 @@
+#!/usr/bin/env python3
+"""
+Tests for the shared TTS server code (tts_core.py, tts_cache.py, tts_audio.py).
+Uses only the standard library and a stand-in engine, so no model, API key or
+network access is needed.
+
+Usage: python3 test_tts_core.py [-v]
+"""
+
+import io
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import tempfile
+import threading
+import zipfile
+import unittest
+import http.client
+from unittest import mock
+
+os.environ.setdefault("TTS_CACHE_SWEEP_INTERVAL", "0")
+
+import tts_core
+from tts_core import FallbackAudio, HTTPError, SingleFlight, TTSEngine, TTSServer, parse_accept, split_sentences
+from tts_cache import FILE_MODE, AudioCache, CacheEntry, CacheIndex, MemoryLRU, cache_name
+from tts_audio import ffmpeg_encoders, join_segments, read_wav, wav_header
+
+SAMPLE_RATE = 16000
+
+
+def tone(text):
+    """A short WAV clip whose samples depend on the text, standing in for speech."""
+    pcm = bytes([len(text) % 256, 0]) * (SAMPLE_RATE // 100)
+    return wav_header(1, 2, SAMPLE_RATE, len(pcm)) + pcm
+
+
+class StandInEngine(TTSEngine):
+    """Synthesizes tones and counts the sentences it was asked for."""
+
+    name = "stand-in"
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.gate = threading.Event()  # sentences containing "slow" wait for it
+        self.gate.set()
+
+    def synthesize(self, text, voice_id, model):
+        with self.lock:
+            self.calls.append(text)
+        if "slow" in text:
+            self.gate.wait(10)
+        if "fail" in text:
+            raise RuntimeError("synthesis failed")
+        return tone(text)
+
+
+class MP3Engine(StandInEngine):
+    """Synthesizes stand-in MP3 frames, falling back to a WAV tone for sentences containing "bad"."""
+
+    name = "stand-in-mp3"
+    content_type = "audio/mpeg"
+
+    def synthesize(self, text, voice_id, model):
+        if "bad" in text.lower():
+            return FallbackAudio(super().synthesize(text, voice_id, model))
+        return b"\xff\xf3" + text.encode()
+
+
+class StreamingEngine(StandInEngine):
+    """Delivers MP3 audio progressively, like the ElevenLabs streaming endpoint."""
+
+    name = "stand-in-stream"
+    content_type = "audio/mpeg"
+
+    def __init__(self):
+        super().__init__()
+        self.closed = []
+        self.held = False  # set if a "slow" sentence had to wait for the client
+
+    def synthesize(self, text, voice_id, model):
+        return b"".join(self.open_stream(text, voice_id, model))
+
+    def open_stream(self, text, voice_id, model):
+        with self.lock:
+            self.calls.append(text)
+        return self.chunks(text)
+
+    def chunks(self, text):
+        try:
+            yield b"\xff\xf3" + text.encode()
+            if "slow" in text and not self.gate.wait(10):
+                self.held = True
+            yield b"\xff\xf3-end"
+        finally:
+            self.closed.append(text)
+
+
+class VoiceEngine(StandInEngine):
+    """Lists voices, counting how often it is asked for them."""
+
+    name = "stand-in-voices"
+
+    def __init__(self):
+        super().__init__()
+        self.version = "loading"
+        self.voice_fetches = 0
+
+    def get_voices(self):
+        self.voice_fetches += 1
+        return [{"id": "one", "name": "One", "status": self.version}]
+
+    def voices_version(self):
+        return self.version
+
+
+def read(data):
+    """Parse raw request bytes with TTSServer.read_request()."""
+    async def parse():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await TTSServer(StandInEngine()).read_request(reader, None)
+    return asyncio.run(parse())
+
+
+class HTTPParsingTest(unittest.TestCase):
+
+    def test_request_with_body(self):
+        body = b'{"text": "Hello."}'
+        request = read(b"POST /tts?x=1 HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                       b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        self.assertEqual((request.method, request.path, request.query), ("POST", "/tts", "x=1"))
+        self.assertEqual(request.headers["content-type"], "application/json")
+        self.assertEqual(request.json(), {"text": "Hello."})
+        self.assertTrue(request.keep_alive)
+
+    def test_get_parameters_and_connection_close(self):
+        request = read(b"GET /tts?text=Hi&speaker=ryan HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertEqual(request.json(), {"text": "Hi", "speaker": "ryan"})
+        self.assertFalse(request.keep_alive)
+        self.assertFalse(read(b"GET /health HTTP/1.0\r\n\r\n").keep_alive)
+
+    def test_eof_and_malformed_requests(self):
+        self.assertIsNone(read(b""))
+        with self.assertRaises(HTTPError) as error:
+            read(b"GARBAGE\r\n\r\n")
+        self.assertEqual(error.exception.status, 400)
+        with self.assertRaises(HTTPError) as error:
+            read(b"POST /tts HTTP/1.1\r\nContent-Length: 99999999\r\n\r\n")
+        self.assertEqual(error.exception.status, 413)
+
+    def test_parse_accept(self):
+        self.assertEqual(parse_accept("audio/ogg;q=0.5, audio/*;q=0.1, audio/wav, bad;q=x"),
+                         {"audio/ogg": 0.5, "audio/*": 0.1, "audio/wav": 1.0, "bad": 0.0})
+        self.assertEqual(parse_accept("Audio/MPEG;q=0.2, audio/mpeg;q=0.7"), {"audio/mpeg": 0.7})
+        self.assertEqual(parse_accept(""), {})
+
+
+class SentenceTest(unittest.TestCase):
+
+    def test_split_sentences_normalizes_whitespace(self):
+        self.assertEqual(split_sentences("One.  Two   words!\tThree"), ["One.", "Two words!", "Three"])
+        self.assertEqual(split_sentences("Line one\n\nline two"), ["Line one", "line two"])
+        self.assertEqual(split_sentences("   "), ["   "])
+
+    def test_join_wav_segments(self):
+        joined = join_segments([tone("One."), tone("Three.")])
+        params, frames = read_wav(joined)
+        self.assertEqual(params, (1, 2, SAMPLE_RATE))
+        self.assertEqual(bytes(frames), bytes(read_wav(tone("One."))[1]) + bytes(read_wav(tone("Three."))[1]))
+        self.assertEqual(len(joined), 44 + len(frames))
+
+    def test_join_keeps_the_native_format(self):
+        id3 = b"ID3\x04\x00\x00\x00\x00\x00\x02ab"
+        mp3 = [id3 + b"\xff\xf3one", tone("Fallback."), id3 + b"\xff\xf3two"]
+        self.assertEqual(join_segments(mp3, "mp3"), id3 + b"\xff\xf3one\xff\xf3two")
+        # A fallback first does not decide the format
+        self.assertEqual(join_segments(mp3[1:], "mp3"), id3 + b"\xff\xf3two")
+        # Without any segment in the native format the first one decides
+        self.assertEqual(read_wav(join_segments([tone("A."), tone("B.")], "mp3"))[0], (1, 2, SAMPLE_RATE))
+
+    def test_missing_sentences_are_synthesized_concurrently(self):
+        class BarrierEngine(StandInEngine):
+            barrier = threading.Barrier(2, timeout=5)
+
+            def synthesize(self, text, voice_id, model):
+                # Serial synthesis would break the barrier
+                self.barrier.wait()
+                return super().synthesize(text, voice_id, model)
+
+        audio = BarrierEngine().synthesize_text("One. Two.", "default", "default")
+        self.assertEqual(len(read_wav(audio)[1]), 2 * len(read_wav(tone("One."))[1]))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_execution(self):
+        flights = SingleFlight()
+        runs = []
+
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return "audio"
+
+        async def main():
+            results = await asyncio.gather(*(flights.do("key", work) for _ in range(5)))
+            return results, dict(flights.calls)
+
+        results, in_flight = asyncio.run(main())
+        self.assertEqual(results, ["audio"] * 5)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(flights.coalesced, 4)
+        self.assertEqual(in_flight, {})
+
+    def test_errors_reach_every_waiter_and_are_not_kept(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+
+        async def main():
+            results = await asyncio.gather(flights.do("key", fail), flights.do("key", fail),
+                                           return_exceptions=True)
+            return results, await flights.do("key", lambda: asyncio.sleep(0, "retried"))
+
+        results, retried = asyncio.run(main())
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(retried, "retried")
+
+    def test_a_cancelled_waiter_does_not_cancel_the_others(self):
+        flights = SingleFlight()
+
+        async def main():
+            first = asyncio.ensure_future(flights.do("key", lambda: asyncio.sleep(0.02, "audio")))
+            second = asyncio.ensure_future(flights.do("key", lambda: asyncio.sleep(0, "other")))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(main()), "audio")
+
+
+class CacheTest(unittest.TestCase):
+    """Tests against an AudioCache in a temporary directory, without a sweeper thread."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="tts-cache-test-")
+        self.addCleanup(self.dir.cleanup)
+        self.cache = self.open_cache()
+
+    def open_cache(self, **options):
+        return AudioCache(self.dir.name, sweep_interval=0, **options)
+
+
+class MemoryCacheTest(CacheTest):
+
+    def test_memory_lru_stays_within_its_budget(self):
+        lru = MemoryLRU(max_bytes=10)
+        lru.put("a", b"aaaa")
+        lru.put("b", b"bbbb")
+        lru.get("a")
+        lru.put("c", b"cccc")
+        self.assertEqual(list(lru.entries), ["a", "c"])
+        self.assertEqual(lru.size, 8)
+        lru.put("big", b"x" * 11)
+        self.assertIsNone(lru.get("big"))
+
+    def test_disk_hits_are_promoted_into_memory(self):
+        self.assertIsNone(self.cache.get("hello.wav"))
+        self.cache.put("hello.wav", b"audio")
+        self.assertEqual(self.cache.get("hello.wav"), b"audio")
+        self.assertEqual(self.cache.memory_hits, 1)
+
+        self.cache.flush()
+        reopened = self.open_cache()
+        self.assertEqual(reopened.get("hello.wav"), b"audio")
+        self.assertEqual(reopened.get("hello.wav"), b"audio")
+        self.assertEqual((reopened.disk_hits, reopened.memory_hits), (1, 1))
+        self.assertEqual(reopened.stats()["memory_entries"], 1)
+
+
+class DiskBudgetTest(CacheTest):
+
+    def test_sweep_keeps_costly_entries(self):
+        cache = self.open_cache(disk_entries=2)
+        cache.put("slow.mp3", b"x", cost=10.0)
+        cache.put("cheap-1.wav", b"x", cost=0.0)
+        cache.put("cheap-2.wav", b"x", cost=0.0)
+        self.assertEqual(cache.sweep(), 2)
+        self.assertEqual([entry.name for entry in cache.select()], ["slow.mp3"])
+        self.assertEqual(sorted(name for name in os.listdir(self.dir.name) if not name.startswith(".")),
+                         ["slow.mp3"])
+
+    def test_sweep_evicts_to_below_the_byte_budget(self):
+        cache = self.open_cache(disk_bytes=100)
+        for index in range(5):
+            cache.put(f"{index}.wav", b"x" * 30)
+            cache.get("0.wav")  # the oldest entry stays in use
+        # Down to 90% of the budget, least recently used first
+        self.assertEqual(cache.sweep(), 2)
+        self.assertEqual(sorted(entry.name for entry in cache.select()), ["0.wav", "3.wav", "4.wav"])
+        self.assertEqual(cache.disk_size, 90)
+        self.assertEqual(cache.sweep(), 0)
+
+    def test_restart_loads_the_index_instead_of_scanning(self):
+        self.cache.put("a.wav", b"aa", engine="one")
+        self.cache.flush()
+        reopened = self.open_cache()
+        self.assertTrue(reopened.indexed)
+        self.assertEqual((len(reopened.entries), reopened.disk_size), (1, 2))
+        self.assertEqual(reopened.entries["a.wav"].engine, "one")
+
+
+class CacheIndexTest(CacheTest):
+
+    def test_index_round_trip(self):
+        index = CacheIndex(os.path.join(self.dir.name, "index.sqlite3"))
+        index.save([CacheEntry("a.wav", "one", "v", "m", 2, 0.5, created=100.0),
+                    CacheEntry("b.wav", created=200.0)], [])
+        index.save([], ["a.wav"])
+        entries, seq = index.load()
+        self.assertEqual([(entry.name, entry.created) for entry in entries], [("b.wav", 200.0)])
+        self.assertEqual(index.load(after=seq), ([], seq))
+
+    def test_purge_by_engine(self):
+        self.cache.put("a.wav", b"aa", engine="one")
+        self.cache.put("b.wav", b"bbb", engine="two")
+        self.assertEqual(self.cache.purge(engine="two"), (1, 3))
+        self.assertIsNone(self.cache.get("b.wav"))
+        self.assertEqual(self.cache.get("a.wav"), b"aa")
+        self.assertEqual(self.cache.summary(), [{"engine": "one", "voice": "", "model": "", "entries": 1, "bytes": 2}])
+
+    def test_entries_saved_by_another_process_are_picked_up(self):
+        # Two servers sharing an indexed directory
+        cache, other = self.open_cache(), self.open_cache()
+        other.put("x.mp3", b"audio", engine="one")
+        # This one syncs before the other one saves its row
+        cache.flush()
+        time.sleep(0.01)
+        other.flush()
+        cache.flush()
+        self.assertEqual(cache.get("x.mp3"), b"audio")
+        self.assertEqual(cache.disk_size, 5)
+
+    def test_entries_indexed_from_old_files_are_picked_up(self):
+        cache = self.open_cache()
+        with open(os.path.join(self.dir.name, "old.wav"), "wb") as f:
+            f.write(b"old")
+        os.utime(os.path.join(self.dir.name, "old.wav"), (1000.0, 1000.0))
+        # A server scanning the directory indexes the file with its old modification time
+        scanning = self.open_cache()
+        scanning.scan()
+        cache.flush()
+        scanning.flush()
+        cache.flush()
+        self.assertEqual(cache.get("old.wav"), b"old")
+
+    def test_index_without_sequence_numbers_is_upgraded(self):
+        path = os.path.join(self.dir.name, "old-index.sqlite3")
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE entries (name TEXT PRIMARY KEY, engine TEXT, voice TEXT, model TEXT, "
+                   "size INTEGER, cost REAL, created REAL, last_access REAL)")
+        db.execute("INSERT INTO entries VALUES ('a.wav', 'one', 'v', 'm', 2, 0.5, 100.0, 150.0)")
+        db.commit()
+        db.close()
+        entries, seq = CacheIndex(path).load()
+        self.assertEqual([entry.as_dict() for entry in entries],
+                         [{"name": "a.wav", "engine": "one", "voice": "v", "model": "m", "size": 2,
+                           "cost": 0.5, "created": 100.0, "last_access": 150.0}])
+        self.assertEqual(seq, 1)
+
+
+class CacheWriteTest(CacheTest):
+
+    def test_cache_names_separate_engines_and_formats(self):
+        names = {cache_name("a", "wav", "Hi.", "v", "m"), cache_name("b", "wav", "Hi.", "v", "m"),
+                 cache_name("a", "mp3", "Hi.", "v", "m"), cache_name("a", "wav", "Hi.v", "", "m")}
+        self.assertEqual(len(names), 4)
+        self.assertEqual(cache_name("a", "mp3", "Hi."), cache_name("a", "mp3", "Hi."))
+        self.assertRegex(cache_name("gtts", "mp3", "Hi."), r"^gtts-[0-9a-f]{32}\.mp3$")
+
+    def test_put_leaves_a_complete_file_and_no_temporary_files(self):
+        self.cache.put("a.wav", b"audio")
+        self.assertEqual(os.listdir(self.dir.name).count("a.wav"), 1)
+        self.assertEqual([name for name in os.listdir(self.dir.name) if name.endswith(".tmp")], [])
+        self.assertEqual(os.stat(os.path.join(self.dir.name, "a.wav")).st_mode & 0o777, FILE_MODE)
+
+    def test_concurrent_readers_never_see_partial_files(self):
+        path = os.path.join(self.dir.name, "shared.wav")
+        blobs = [bytes([index]) * 200000 for index in range(1, 5)]
+        self.cache.put("shared.wav", blobs[0])
+        torn = []
+        done = threading.Event()
+
+        def read_files():
+            while not done.is_set():
+                with open(path, "rb") as f:
+                    data = f.read()
+                if data not in blobs:
+                    torn.append(len(data))
+
+        readers = [threading.Thread(target=read_files) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        for _ in range(20):
+            for blob in blobs:
+                self.cache.put("shared.wav", blob)
+        done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(torn, [])
+
+
+class CacheWriterTest(CacheTest):
+
+    def temporary_files(self):
+        return [name for name in os.listdir(self.dir.name) if name.endswith(".tmp")]
+
+    def test_commit_stores_the_whole_entry(self):
+        writer = self.cache.writer("streamed.mp3", engine="stand-in", voice="v")
+        writer.write(b"part 1, ")
+        self.assertIsNone(self.cache.get("streamed.mp3"))
+        writer.write(b"part 2")
+        self.assertEqual(writer.commit(cost=1.0), b"part 1, part 2")
+        self.assertEqual(self.cache.get("streamed.mp3"), b"part 1, part 2")
+        self.assertEqual(self.cache.select(voice="v")[0].cost, 1.0)
+        self.assertEqual(self.temporary_files(), [])
+        self.assertEqual(os.stat(os.path.join(self.dir.name, "streamed.mp3")).st_mode & 0o777, FILE_MODE)
+
+    def test_abort_leaves_nothing(self):
+        writer = self.cache.writer("aborted.mp3")
+        writer.write(b"partial")
+        writer.abort()
+        self.assertIsNone(self.cache.get("aborted.mp3"))
+        self.assertEqual(self.cache.select(), [])
+        self.assertEqual(self.temporary_files(), [])
+
+
+def fake_transcode(audio_data, audio_format):
+    """Stands in for the ffmpeg conversion."""
+    return f"{audio_format}:".encode() + bytes(audio_data)
+
+
+class ConversionCacheTest(CacheTest):
+
+    def setUp(self):
+        super().setUp()
+        self.engine = MP3Engine()
+        self.engine.cache = self.cache
+        transcode = mock.patch.object(tts_core, "transcode", side_effect=fake_transcode)
+        self.transcode = transcode.start()
+        self.addCleanup(transcode.stop)
+
+    def test_converted_audio_is_cached(self):
+        encoded = self.engine.synthesize_as("Good one.", "v", "m", "opus")
+        self.assertEqual(encoded, b"opus:\xff\xf3Good one.")
+        self.assertEqual(self.engine.synthesize_as("Good one.", "v", "m", "opus"), encoded)
+        self.assertEqual(self.transcode.call_count, 1)
+        self.assertEqual(self.engine.calls, [])  # MP3Engine only records sentences it falls back on
+
+    def test_converted_fallback_audio_is_not_cached(self):
+        for _ in range(2):
+            encoded = self.engine.synthesize_as("Bad one.", "v", "m", "opus")
+            self.assertIsInstance(encoded, FallbackAudio)
+        self.assertEqual(self.transcode.call_count, 2)
+        self.assertEqual(self.engine.calls, ["Bad one.", "Bad one."])
+        self.assertEqual(self.cache.select(), [])
+
+    def test_failed_conversion_sends_the_audio_as_is(self):
+        self.transcode.side_effect = RuntimeError("no encoder")
+        self.assertEqual(self.engine.synthesize_as("Good one.", "v", "m", "opus"), b"\xff\xf3Good one.")
+        self.assertEqual(self.cache.select(), [])
+
+
+class ServerTest(unittest.TestCase):
+    """Runs a TTSServer on an ephemeral port and talks to it over HTTP."""
+
+    engine_class = StandInEngine
+    server_options = {"workers": 4}
+
+    def setUp(self):
+        self.engine = self.engine_class()
+        self.server = TTSServer(self.engine, **self.server_options)
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+        listener = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.server.handle_connection, "127.0.0.1", 0), self.loop).result()
+        self.port = listener.sockets[0].getsockname()[1]
+
+        async def shutdown():
+            listener.close()
+            # The clients have hung up by now; let their connections finish before the loop goes
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if tasks:
+                await asyncio.wait(tasks, timeout=5)
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+            self.loop.close()
+            self.server.executor.shutdown()
+        self.addCleanup(stop)
+
+    def connect(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        self.addCleanup(connection.close)
+        return connection
+
+    def request(self, method, path, payload=None, headers=None, connection=None):
+        connection = connection or self.connect()
+        connection.request(method, path, None if payload is None else json.dumps(payload), headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def post(self, path, payload, headers=None):
+        return self.request("POST", path, payload, headers)
+
+    def wait_pending(self, count):
+        """Wait until count requests hold a place in the worker queue."""
+        for _ in range(100):
+            if self.server.pending == count:
+                return
+            time.sleep(0.01)
+        self.fail(f"{self.server.pending} requests pending, expected {count}")
+
+    def assertReleased(self):
+        """The worker queue place of a streamed response is released after its last chunk is sent."""
+        self.wait_pending(0)
+
+
+class CoreTest(ServerTest):
+
+    def test_keep_alive_connection_serves_every_route(self):
+        connection = self.connect()
+        for method, path in (("GET", "/health"), ("GET", "/voices"), ("GET", "/models")):
+            response, body = self.request(method, path, connection=connection)
+            self.assertEqual(response.status, 200, path)
+            self.assertEqual(response.getheader("Connection"), "keep-alive")
+            self.assertEqual(response.getheader("Access-Control-Allow-Origin"), "*")
+            json.loads(body)
+        response, body = self.request("POST", "/tts", {"text": "Hello."}, connection=connection)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, tone("Hello."))
+
+    def test_preflight_and_unknown_paths(self):
+        response, _ = self.request("OPTIONS", "/tts")
+        self.assertEqual(response.status, 200)
+        self.assertIn("POST", response.getheader("Access-Control-Allow-Methods"))
+        response, body = self.request("GET", "/nowhere")
+        self.assertEqual(response.status, 404)
+        self.assertEqual(json.loads(body), {"error": "Not found"})
+
+    def test_synthesis_errors_become_500(self):
+        response, body = self.post("/tts", {"text": "Please fail."})
+        self.assertEqual(response.status, 500)
+        self.assertIn("failed", json.loads(body)["error"])
+
+
+class SentenceCacheTest(ServerTest):
+
+    def test_sentences_are_joined_and_repeats_synthesized_once(self):
+        response, body = self.post("/tts", {"text": "Hello there. Hi. Hello there."})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/wav")
+        params, frames = read_wav(body)
+        self.assertEqual(params, (1, 2, SAMPLE_RATE))
+        expected = [bytes(read_wav(tone(s))[1]) for s in ("Hello there.", "Hi.", "Hello there.")]
+        self.assertEqual(bytes(frames), b"".join(expected))
+        self.assertEqual(sorted(self.engine.calls), ["Hello there.", "Hi."])
+
+
+class CoalescingTest(ServerTest):
+
+    def test_identical_requests_are_synthesized_once(self):
+        self.engine.gate.clear()
+        self.addCleanup(self.engine.gate.set)
+        results = []
+        clients = [threading.Thread(target=lambda: results.append(self.post("/tts", {"text": "A slow one."})))
+                   for _ in range(3)]
+        for client in clients:
+            client.start()
+        for _ in range(100):
+            if self.server.flights.coalesced == 2:
+                break
+            time.sleep(0.01)
+        self.engine.gate.set()
+        for client in clients:
+            client.join()
+        self.assertEqual(self.server.flights.coalesced, 2)
+        self.assertEqual(self.engine.calls, ["A slow one."])
+        self.assertEqual([(response.status, body) for response, body in results], [(200, tone("A slow one."))] * 3)
+
+
+class BackpressureTest(ServerTest):
+
+    server_options = {"workers": 1, "queue_size": 0, "retry_after": 3}
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        self.engine.gate.clear()
+        slow = threading.Thread(target=self.post, args=("/tts", {"text": "A slow one."}))
+        slow.start()
+        self.addCleanup(slow.join)
+        self.addCleanup(self.engine.gate.set)
+        self.wait_pending(1)
+
+        response, body = self.post("/tts", {"text": "Another one."})
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader("Retry-After"), "3")
+        self.assertEqual(json.loads(body), {"error": "Server busy"})
+        # Requests that need no worker are still answered
+        response, body = self.request("GET", "/health")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)["requests"]["rejected"], 1)
+
+        self.engine.gate.set()
+        slow.join()
+        response, _ = self.post("/tts", {"text": "Another one."})
+        self.assertEqual(response.status, 200)
+
+
+class CacheAdminTest(ServerTest):
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory(prefix="tts-cache-test-")
+        self.addCleanup(cache_dir.cleanup)
+        self.engine.cache = AudioCache(cache_dir.name, sweep_interval=0)
+        self.engine.cache.put("a.wav", b"aa", engine="stand-in", voice="ryan")
+        self.engine.cache.put("b.wav", b"bbb", engine="stand-in", voice="emma")
+
+    def test_stats_and_entries(self):
+        response, body = self.request("GET", "/cache")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(sorted(group["voice"] for group in json.loads(body)["groups"]), ["emma", "ryan"])
+        response, body = self.request("GET", "/cache/entries?voice=ryan")
+        self.assertEqual([entry["name"] for entry in json.loads(body)["entries"]], ["a.wav"])
+
+    def test_purge_by_voice(self):
+        response, body = self.post("/cache/purge", {"voice": "ryan"})
+        self.assertEqual((response.status, json.loads(body)), (200, {"removed": 1, "bytes": 2}))
+        self.assertIsNone(self.engine.cache.get("a.wav"))
+        response, _ = self.post("/cache/purge", {})
+        self.assertEqual(response.status, 400)
+
+    def test_purge_refuses_other_sites_and_missing_tokens(self):
+        response, _ = self.post("/cache/purge", {"all": True}, {"Origin": "https://example.com"})
+        self.assertEqual(response.status, 403)
+        with mock.patch.object(tts_core, "TTS_ADMIN_TOKEN", "secret"):
+            response, _ = self.post("/cache/purge", {"all": True})
+            self.assertEqual(response.status, 401)
+            self.assertEqual(response.getheader("WWW-Authenticate"), "Bearer")
+            response, _ = self.post("/cache/purge", {"all": True}, {"Authorization": "Bearer secret"})
+            self.assertEqual(response.status, 200)
+        self.assertEqual(self.engine.cache.select(), [])
+
+
+class VoicesTest(ServerTest):
+
+    engine_class = VoiceEngine
+
+    def test_unchanged_list_is_answered_with_304(self):
+        connection = self.connect()
+        response, body = self.request("GET", "/voices", connection=connection)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body), {"voices": [{"id": "one", "name": "One", "status": "loading"}]})
+        etag = response.getheader("ETag")
+        self.assertRegex(etag, r'^"[0-9a-f]{32}"$')
+
+        response, body = self.request("GET", "/voices", headers={"If-None-Match": etag}, connection=connection)
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(response.getheader("ETag"), etag)
+        # The connection stays usable after a bodiless 304
+        response, _ = self.request("GET", "/voices", headers={"If-None-Match": '"other"'}, connection=connection)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.engine.voice_fetches, 1)
+
+    def test_version_change_fetches_the_list_again(self):
+        response, _ = self.request("GET", "/voices")
+        etag = response.getheader("ETag")
+        self.engine.version = "ready"
+        response, body = self.request("GET", "/voices", headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)["voices"][0]["status"], "ready")
+        self.assertNotEqual(response.getheader("ETag"), etag)
+        self.assertEqual(self.engine.voice_fetches, 2)
+
+    def test_stale_list_is_served_while_it_is_refreshed(self):
+        self.request("GET", "/voices")
+        self.server.voices.ttl = 0
+        response, _ = self.request("GET", "/voices")
+        self.assertEqual(response.status, 200)
+        for _ in range(100):
+            if self.engine.voice_fetches == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.engine.voice_fetches, 2)
+
+
+class BatchTest(ServerTest):
+
+    def parts(self, response, body):
+        """Split a multipart/mixed body into {item index: (content type, payload)}."""
+        boundary = response.getheader("Content-Type").split("boundary=")[1].encode()
+        parts = {}
+        rest = body
+        while rest.startswith(b"--" + boundary + b"\r\n"):
+            head, _, rest = rest[len(boundary) + 4:].partition(b"\r\n\r\n")
+            headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+            length = int(headers["Content-Length"])
+            parts[int(headers["X-Item-Index"])] = (headers["Content-Type"], rest[:length])
+            rest = rest[length + 2:]
+        self.assertEqual(rest, b"--" + boundary + b"--\r\n")
+        return parts
+
+    def test_multipart_results_and_errors(self):
+        items = [{"text": "One."}, {"text": "Please fail."}, {"text": "One."}, {"text": "Two."}]
+        response, body = self.post("/tts/batch", {"items": items})
+        self.assertEqual(response.status, 200)
+        parts = self.parts(response, body)
+        self.assertEqual(sorted(parts), [0, 1, 2, 3])
+        self.assertEqual(parts[0], ("audio/wav", tone("One.")))
+        self.assertEqual(parts[2], parts[0])
+        self.assertEqual(parts[3][1], tone("Two."))
+        self.assertEqual(parts[1][0], "application/json")
+        self.assertIn("failed", json.loads(parts[1][1])["error"])
+        self.assertEqual(sorted(self.engine.calls), ["One.", "Please fail.", "Two."])
+        self.assertReleased()
+
+    def test_zip_archive_with_index(self):
+        items = [{"text": "One.", "speaker": "ryan"}, {"text": "Please fail."}]
+        response, body = self.post("/tts/batch", {"items": items, "format": "zip"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "application/zip")
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            index = json.loads(archive.read("index.json"))["items"]
+            self.assertEqual(index[0]["speaker"], "ryan")
+            self.assertEqual(archive.read(index[0]["file"]), tone("One."))
+            self.assertEqual(index[0]["bytes"], len(tone("One.")))
+            self.assertNotIn("file", index[1])
+            self.assertIn("failed", index[1]["error"])
+        self.assertReleased()
+
+    def test_invalid_batches_are_rejected(self):
+        for payload in ({}, {"items": []}, {"items": "One."}, {"items": [{"speaker": "ryan"}]},
+                        {"items": [{"text": "a"}], "format": "tar"},
+                        {"items": [{"text": "a"}] * (tts_core.TTS_BATCH_MAX_ITEMS + 1)}):
+            with self.subTest(payload=str(payload)[:40]):
+                response, body = self.post("/tts/batch", payload)
+                self.assertEqual(response.status, 400)
+                self.assertIn("error", json.loads(body))
+        self.assertEqual(self.engine.calls, [])
+        self.assertReleased()
+
+
+class StreamTest(ServerTest):
+
+    def test_wav_sentences_form_one_stream(self):
+        response, body = self.post("/tts", {"text": "One. Two. Three.", "stream": True})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        params, frames = read_wav(body)
+        self.assertEqual(params, (1, 2, SAMPLE_RATE))
+        self.assertEqual(bytes(frames), b"".join(bytes(read_wav(tone(s))[1]) for s in ("One.", "Two.", "Three.")))
+        self.assertReleased()
+
+
+class StreamFallbackTest(ServerTest):
+
+    engine_class = MP3Engine
+
+    def test_fallback_in_another_format_is_left_out(self):
+        response, body = self.post("/tts", {"text": "Good one. Bad two. Good three.", "stream": True})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/mpeg")
+        self.assertEqual(body, b"\xff\xf3Good one.\xff\xf3Good three.")
+
+    def test_stream_keeps_the_format_of_its_first_sentence(self):
+        response, body = self.post("/tts", {"text": "Bad one. Good two. Bad three.", "stream": True})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/wav")
+        _, frames = read_wav(body)
+        self.assertEqual(bytes(frames), b"".join(bytes(read_wav(tone(s))[1]) for s in ("Bad one.", "Bad three.")))
+        self.assertReleased()
+
+
+class RelayTest(ServerTest):
+
+    engine_class = StreamingEngine
+
+    def test_progressive_audio_is_relayed_in_order(self):
+        response, body = self.post("/tts", {"text": "One. Two.", "stream": True})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/mpeg")
+        self.assertEqual(body, b"\xff\xf3One.\xff\xf3-end\xff\xf3Two.\xff\xf3-end")
+        self.assertEqual(sorted(self.engine.closed), ["One.", "Two."])
+        self.assertReleased()
+
+    def test_chunks_are_sent_before_the_sentence_is_complete(self):
+        self.engine.gate.clear()
+        connection = self.connect()
+        connection.request("POST", "/tts", json.dumps({"text": "A slow one.", "stream": True}))
+        response = connection.getresponse()
+        self.assertEqual(response.read(len(b"\xff\xf3A slow one.")), b"\xff\xf3A slow one.")
+        self.engine.gate.set()
+        self.assertEqual(response.read(), b"\xff\xf3-end")
+        self.assertFalse(self.engine.held)
+        self.assertReleased()
+
+
+class FormatTest(ServerTest):
+
+    def formats(self, *formats):
+        patch = mock.patch.object(tts_core, "audio_formats", return_value=list(formats))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_unknown_and_unavailable_formats_are_rejected(self):
+        self.formats("wav", "pcm")
+        response, body = self.post("/tts", {"text": "Hi.", "format": "flac"})
+        self.assertEqual(response.status, 400)
+        self.assertIn("format", json.loads(body)["error"])
+        response, body = self.post("/tts", {"text": "Hi.", "format": "mp3"})
+        self.assertEqual(response.status, 406)
+        self.assertEqual(self.engine.calls, [])
+
+    def test_pcm_is_cut_from_wav(self):
+        response, body = self.post("/tts", {"text": "Hi.", "format": "pcm"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/pcm;rate=16000;channels=1;bits=16")
+        self.assertEqual(body, bytes(read_wav(tone("Hi."))[1]))
+
+    def test_accept_header_picks_the_format(self):
+        self.formats("wav", "pcm", "mp3")
+        # Between equally acceptable formats the native one wins
+        cases = (("audio/mpeg", b"mp3:" + tone("Hi.")), ("audio/*", tone("Hi.")),
+                 ("audio/mpeg;q=0.5, audio/wav", tone("Hi.")), ("audio/ogg", tone("Hi.")), ("", tone("Hi.")))
+        with mock.patch.object(tts_core, "transcode", side_effect=fake_transcode):
+            for accept, expected in cases:
+                with self.subTest(accept=accept):
+                    response, body = self.post("/tts", {"text": "Hi."}, {"Accept": accept})
+                    self.assertEqual(response.status, 200)
+                    self.assertEqual(response.getheader("Vary"), "Accept")
+                    self.assertEqual(body, expected)
+
+    @unittest.skipUnless("libmp3lame" in ffmpeg_encoders(), "needs ffmpeg with libmp3lame")
+    def test_wav_is_converted_to_mp3(self):
+        response, body = self.post("/tts", {"text": "Hi.", "format": "mp3"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"), "audio/mpeg")
+        self.assertTrue(body.startswith(b"ID3") or body[:1] == b"\xff")
+
+
+if __name__ == "__main__":
+    unittest.main()
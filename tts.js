@@ -15,6 +15,10 @@ class TTSHandler {
     this.model = config.openVoiceModel || 'default';
     this.speaker = config.openVoiceSpeaker || 'default';
     
+    // Stream audio sentence by sentence so playback starts before synthesis finishes
+    this.streaming = config && typeof config.openVoiceStreaming !== 'undefined' ? Boolean(config.openVoiceStreaming) : true;
+    this.maxStreamURLLength = 8000;
+    
     // Audio element reference for controlling playback
     this.currentAudio = null;
     
@@ -200,6 +204,17 @@ class TTSHandler {
       };
       console.log(`Request #${requestId} body:`, requestBody);
       
+      // Streamed audio is fetched by the audio element itself via GET, so it can
+      // start playing after the first sentence; very long texts fall back to POST
+      if (this.streaming) {
+        const params = new URLSearchParams({ ...requestBody, stream: '1' });
+        const streamURL = `${this.serverURL}/tts?${params}`;
+        if (streamURL.length <= this.maxStreamURLLength) {
+          console.log(`Streaming TTS audio for request #${requestId}`);
+          return this.playAudioURL(streamURL, requestId, 100);
+        }
+      }
+      
       const response = await fetch(`${this.serverURL}/tts`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
@@ -235,107 +250,7 @@ class TTSHandler {
         const audioUrl = URL.createObjectURL(audioBlob);
         console.log(`Created blob URL: ${audioUrl}`);
         
-        // Create new audio element with debugging
-        const audio = new Audio();
-        
-        // Add listeners before setting source
-        audio.oncanplay = () => console.log(`Audio can play now [request #${requestId}]`);
-        audio.oncanplaythrough = () => console.log(`Audio can play through without buffering [request #${requestId}]`);
-        audio.onwaiting = () => console.log(`Audio playback waiting for more data [request #${requestId}]`);
-        
-        // Set the source
-        audio.src = audioUrl;
-        audio.load(); // Force loading
-        
-        console.log(`Audio element created and source set [request #${requestId}]`);
-        
-        // Store reference to the audio element so we can stop it later
-        this.currentAudio = audio;
-        
-        return new Promise((resolve) => {
-          // Set volume explicitly
-          audio.volume = 1.0;
-          
-          audio.onended = () => {
-            console.log(`Audio playback completed [request #${requestId}]`);
-            URL.revokeObjectURL(audioUrl); // Clean up
-            this.currentAudio = null; // Clear reference
-            resolve(true);
-          };
-          
-          audio.onerror = (event) => {
-            console.error(`Audio playback error [request #${requestId}]:`, 
-                         audio.error ? audio.error.code : 'unknown error', 
-                         audio.error ? audio.error.message : '');
-            URL.revokeObjectURL(audioUrl); // Clean up
-            this.currentAudio = null; // Clear reference
-            resolve(false);
-          };
-          
-          // Wait until the audio is properly loaded before playing
-          let retryCount = 0;
-          const MAX_RETRIES = 10; // Only try for ~1 second
-          
-          const checkAndPlay = () => {
-            // Check if the audio is actually ready to play
-            console.log(`Audio state check: readyState=${audio.readyState}, duration=${audio.duration}`);
-            
-            // Add check for failed or empty audio
-            if (audio.error || (audio.readyState > 1 && audio.duration === 0)) {
-              console.log(`Audio appears to be empty or invalid [request #${requestId}], ending playback attempt`);
-              URL.revokeObjectURL(audioUrl); // Clean up
-              this.currentAudio = null; // Clear reference
-              resolve(false);
-              return;
-            }
-            
-            // Limit retries to avoid infinite loops
-            if (retryCount >= MAX_RETRIES) {
-              console.log(`Giving up after ${MAX_RETRIES} retries [request #${requestId}]`);
-              URL.revokeObjectURL(audioUrl); // Clean up
-              this.currentAudio = null; // Clear reference
-              resolve(false);
-              return;
-            }
-            
-            if (audio.readyState >= 2) { // HAVE_CURRENT_DATA or better
-              console.log(`Audio is ready to play [request #${requestId}]`);
-              
-              // Play with promise and catch errors
-              const playPromise = audio.play();
-              
-              if (playPromise !== undefined) {
-                playPromise
-                  .then(() => {
-                    console.log(`Audio playback started successfully [request #${requestId}]`);
-                  })
-                  .catch(error => {
-                    console.error(`Failed to play audio [request #${requestId}]:`, error);
-                    URL.revokeObjectURL(audioUrl); // Clean up
-                    this.currentAudio = null; // Clear reference
-                    resolve(false);
-                  });
-              } else {
-                console.log(`Play didn't return a promise, assuming playback started [request #${requestId}]`);
-              }
-            } else {
-              // Not ready yet, check again in 100ms
-              console.log(`Audio not ready yet, waiting... [request #${requestId}], retry #${retryCount+1}`);
-              retryCount++;
-              setTimeout(checkAndPlay, 100);
-            }
-          };
-          
-          // Add error handler for decoding errors
-          audio.onerror = function() {
-            console.error(`Audio failed to load: ${audio.error ? audio.error.message : 'unknown error'}`);
-            URL.revokeObjectURL(audioUrl); // Clean up
-            resolve(false);
-          };
-          
-          // Start checking if audio is ready, with a short initial delay
-          setTimeout(checkAndPlay, 200);
-        });
+        return this.playAudioURL(audioUrl, requestId);
       } else {
         console.error('TTS server error:', response.status);
         try {
@@ -352,6 +267,111 @@ class TTSHandler {
     }
   }
   
+  // Play audio from a URL, resolving when playback ends or fails
+  playAudioURL(audioUrl, requestId, maxRetries = 10) {
+    // Create new audio element with debugging
+    const audio = new Audio();
+    
+    // Add listeners before setting source
+    audio.oncanplay = () => console.log(`Audio can play now [request #${requestId}]`);
+    audio.oncanplaythrough = () => console.log(`Audio can play through without buffering [request #${requestId}]`);
+    audio.onwaiting = () => console.log(`Audio playback waiting for more data [request #${requestId}]`);
+    
+    // Set the source
+    audio.src = audioUrl;
+    audio.load(); // Force loading
+    
+    console.log(`Audio element created and source set [request #${requestId}]`);
+    
+    // Store reference to the audio element so we can stop it later
+    this.currentAudio = audio;
+    
+    return new Promise((resolve) => {
+      // Set volume explicitly
+      audio.volume = 1.0;
+      
+      audio.onended = () => {
+        console.log(`Audio playback completed [request #${requestId}]`);
+        URL.revokeObjectURL(audioUrl); // Clean up
+        this.currentAudio = null; // Clear reference
+        resolve(true);
+      };
+      
+      audio.onerror = (event) => {
+        console.error(`Audio playback error [request #${requestId}]:`, 
+                     audio.error ? audio.error.code : 'unknown error', 
+                     audio.error ? audio.error.message : '');
+        URL.revokeObjectURL(audioUrl); // Clean up
+        this.currentAudio = null; // Clear reference
+        resolve(false);
+      };
+      
+      // Wait until the audio is properly loaded before playing
+      let retryCount = 0;
+      const MAX_RETRIES = maxRetries; // Only try for ~maxRetries/10 seconds
+      
+      const checkAndPlay = () => {
+        // Check if the audio is actually ready to play
+        console.log(`Audio state check: readyState=${audio.readyState}, duration=${audio.duration}`);
+        
+        // Add check for failed or empty audio
+        if (audio.error || (audio.readyState > 1 && audio.duration === 0)) {
+          console.log(`Audio appears to be empty or invalid [request #${requestId}], ending playback attempt`);
+          URL.revokeObjectURL(audioUrl); // Clean up
+          this.currentAudio = null; // Clear reference
+          resolve(false);
+          return;
+        }
+        
+        // Limit retries to avoid infinite loops
+        if (retryCount >= MAX_RETRIES) {
+          console.log(`Giving up after ${MAX_RETRIES} retries [request #${requestId}]`);
+          URL.revokeObjectURL(audioUrl); // Clean up
+          this.currentAudio = null; // Clear reference
+          resolve(false);
+          return;
+        }
+        
+        if (audio.readyState >= 2) { // HAVE_CURRENT_DATA or better
+          console.log(`Audio is ready to play [request #${requestId}]`);
+          
+          // Play with promise and catch errors
+          const playPromise = audio.play();
+          
+          if (playPromise !== undefined) {
+            playPromise
+              .then(() => {
+                console.log(`Audio playback started successfully [request #${requestId}]`);
+              })
+              .catch(error => {
+                console.error(`Failed to play audio [request #${requestId}]:`, error);
+                URL.revokeObjectURL(audioUrl); // Clean up
+                this.currentAudio = null; // Clear reference
+                resolve(false);
+              });
+          } else {
+            console.log(`Play didn't return a promise, assuming playback started [request #${requestId}]`);
+          }
+        } else {
+          // Not ready yet, check again in 100ms
+          console.log(`Audio not ready yet, waiting... [request #${requestId}], retry #${retryCount+1}`);
+          retryCount++;
+          setTimeout(checkAndPlay, 100);
+        }
+      };
+      
+      // Add error handler for decoding errors
+      audio.onerror = function() {
+        console.error(`Audio failed to load: ${audio.error ? audio.error.message : 'unknown error'}`);
+        URL.revokeObjectURL(audioUrl); // Clean up
+        resolve(false);
+      };
+      
+      // Start checking if audio is ready, with a short initial delay
+      setTimeout(checkAndPlay, 200);
+    });
+  }
+  
   // Set speech rate (0.1 to 10)
   setRate(rate) {
     if (rate >= 0.1 && rate <= 10) {
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Audio container helpers shared by the Headroom TTS servers.
+Splits WAV/MP3 blobs into their parts so separately synthesized sentences can
+be streamed or joined into a single file, and converts audio between the
+formats /tts can be asked for.
+"""
+
+import os
+import wave
+import shutil
+import struct
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger("tts-audio")
+
+# Size used in WAV headers when the final length is not known yet
+STREAMING_SIZE = 0xFFFFFFFF
+
+# Encoding settings (override with environment variables)
+TTS_FFMPEG = os.environ.get("TTS_FFMPEG") or shutil.which("ffmpeg")
+TTS_MP3_BITRATE = os.environ.get("TTS_MP3_BITRATE", "64k")
+TTS_OPUS_BITRATE = os.environ.get("TTS_OPUS_BITRATE", "32k")
+
+# Output formats in order of preference: name -> (content type, media types requesting it)
+AUDIO_FORMATS = {
+    "wav": ("audio/wav", ("audio/wav", "audio/x-wav", "audio/wave", "audio/vnd.wave")),
+    "pcm": ("audio/pcm", ("audio/pcm", "audio/l16")),
+    "mp3": ("audio/mpeg", ("audio/mpeg", "audio/mp3")),
+    "opus": ("audio/ogg; codecs=opus", ("audio/ogg", "audio/opus", "application/ogg")),
+}
+
+# ffmpeg encoder and output arguments for each format ffmpeg produces
+FFMPEG_OUTPUTS = {
+    "wav": ("pcm_s16le", ["-c:a", "pcm_s16le", "-f", "wav"]),
+    "mp3": ("libmp3lame", ["-c:a", "libmp3lame", "-b:a", TTS_MP3_BITRATE, "-f", "mp3"]),
+    "opus": ("libopus", ["-c:a", "libopus", "-b:a", TTS_OPUS_BITRATE, "-f", "ogg"]),
+}
+
+
+def is_wav(data):
+    return data[:4] == b"RIFF" and data[8:12] == b"WAVE"
+
+
+def read_wav(data):
+    """Return ((channels, sample_width, sample_rate), pcm_frames) for a WAV blob.
+
+    pcm_frames is a memoryview into data, so joining or streaming segments
+    does not copy their samples an extra time.
+    """
+    view = memoryview(data)
+    params = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        size = int.from_bytes(view[offset + 4:offset + 8], "little")
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", view, body)
+            params = (channels, (bits + 7) // 8, sample_rate)
+        elif chunk_id == b"data" and params is not None:
+            # Streaming headers give the maximum size, so clamp to what is there
+            frame_size = params[0] * params[1]
+            length = min(size, len(view) - body)
+            return params, view[body:body + length - length % frame_size]
+        offset = body + size + (size & 1)
+    raise wave.Error("Not a PCM WAV file")
+
+
+def wav_header(channels, sample_width, sample_rate, data_size=STREAMING_SIZE):
+    """Build a 44-byte PCM WAV header.
+
+    With the default data_size the header describes a stream of unknown length,
+    which browsers play progressively until the connection ends.
+    """
+    if data_size == STREAMING_SIZE:
+        riff_size = STREAMING_SIZE
+    else:
+        riff_size = 36 + data_size
+    byte_rate = sample_rate * channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", riff_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8,
+        b"data", data_size,
+    )
+
+
+def strip_id3(data):
+    """Remove a leading ID3v2 tag so MP3 segments can be concatenated frame by frame."""
+    if data[:3] != b"ID3" or len(data) < 10:
+        return data
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return data[10 + size + footer:]
+
+
+def join_segments(segments, audio_format=None):
+    """Join separately synthesized audio files into one file.
+
+    WAV segments are merged under a single header with the correct length; MP3
+    segments are concatenated. The result is in audio_format ("wav" or "mp3",
+    normally the engine's own format) if any segment is, otherwise in the
+    format of the first segment. Segments in the other format (e.g. a WAV
+    fallback sound among MP3 sentences) are skipped.
+    """
+    if len(segments) == 1:
+        return segments[0]
+
+    formats = [source_format(data) for data in segments]
+    if audio_format not in formats:
+        audio_format = formats[0]
+
+    if audio_format == "wav":
+        params = None
+        parts = []
+        for data in segments:
+            if not is_wav(data):
+                logger.warning("Skipping non-WAV segment while joining WAV audio")
+                continue
+            segment_params, frames = read_wav(data)
+            if params is None:
+                params = segment_params
+            elif segment_params != params:
+                logger.warning(f"Skipping segment with format {segment_params}, expected {params}")
+                continue
+            parts.append(frames)
+        pcm = b"".join(parts)
+        return wav_header(*params, data_size=len(pcm)) + pcm
+
+    parts = []
+    for data in segments:
+        if is_wav(data):
+            logger.warning("Skipping WAV segment while joining MP3 audio")
+            continue
+        parts.append(strip_id3(data) if parts else data)
+    return b"".join(parts)
+
+
+class SegmentStreamer:
+    """Turns a sequence of complete audio files into one continuous byte stream.
+
+    The first WAV segment produces a streaming header followed by its samples;
+    later WAV segments contribute their samples only. MP3 segments are passed
+    through with their ID3 tags removed after the first one. As in
+    join_segments(), segments in another format than the first one (e.g. a WAV
+    fallback sound among MP3 sentences) or with other WAV parameters are
+    skipped.
+    """
+
+    def __init__(self):
+        self.format = None
+        self.params = None
+
+    def feed(self, data):
+        """Return the bytes to send for the next segment, or None to skip it."""
+        audio_format = source_format(data)
+        if self.format is None:
+            self.format = audio_format
+            if audio_format == "wav":
+                self.params, frames = read_wav(data)
+                return wav_header(*self.params) + frames
+            return data
+
+        if audio_format != self.format:
+            logger.warning(f"Skipping {audio_format} segment in {self.format} stream")
+            return None
+        if audio_format == "wav":
+            params, frames = read_wav(data)
+            if params != self.params:
+                logger.warning(f"Skipping segment with format {params}, stream format is {self.params}")
+                return None
+            return frames
+        return strip_id3(data)
+
+
+def source_format(data):
+    """Return "wav" or "mp3" for audio produced by an engine."""
+    return "wav" if is_wav(data) else "mp3"
+
+
+# Encoders found by ffmpeg_encoders(); ffmpeg is only asked once per process
+encoders_lock = threading.Lock()
+encoders_found = None
+
+
+def ffmpeg_encoders():
+    """Return the names of the audio encoders of the local ffmpeg (none without ffmpeg).
+
+    The first call runs ffmpeg, which can take a while; concurrent callers
+    wait for it instead of running ffmpeg again.
+    """
+    global encoders_found
+    with encoders_lock:
+        if encoders_found is None:
+            encoders_found = find_encoders()
+        return encoders_found
+
+
+def find_encoders():
+    if not TTS_FFMPEG:
+        return frozenset()
+    try:
+        result = subprocess.run([TTS_FFMPEG, "-hide_banner", "-encoders"],
+                                capture_output=True, timeout=10, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Cannot run ffmpeg ({e}), audio will not be transcoded")
+        return frozenset()
+    encoders = set()
+    for line in result.stdout.decode("utf-8", "replace").splitlines():
+        fields = line.split()
+        if len(fields) > 1 and fields[0].startswith("A"):
+            encoders.add(fields[1])
+    return frozenset(encoders)
+
+
+def audio_formats(native):
+    """Return the formats audio in native format ("wav" or "mp3") can be served in.
+
+    The native format comes first. Raw PCM is cut from WAV without encoding;
+    everything else needs an ffmpeg with the matching encoder.
+    """
+    encoders = ffmpeg_encoders()
+    formats = [native]
+    for audio_format in AUDIO_FORMATS:
+        if audio_format == native:
+            continue
+        if audio_format == "pcm":
+            available = native == "wav" or "pcm_s16le" in encoders
+        else:
+            available = FFMPEG_OUTPUTS[audio_format][0] in encoders
+        if available:
+            formats.append(audio_format)
+    return formats
+
+
+def transcode(data, audio_format):
+    """Convert WAV or MP3 audio to audio_format ("wav", "mp3" or "opus") with ffmpeg."""
+    encoder, args = FFMPEG_OUTPUTS[audio_format]
+    if encoder not in ffmpeg_encoders():
+        raise ValueError(f"No ffmpeg with the {encoder} encoder to produce {audio_format}")
+    result = subprocess.run([TTS_FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-vn",
+                             *args, "pipe:1"], input=data, capture_output=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    if audio_format == "wav":
+        # ffmpeg cannot seek back in a pipe to fill in the sizes
+        params, frames = read_wav(result.stdout)
+        return wav_header(*params, data_size=len(frames)) + frames
+    return result.stdout
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Audio cache shared by the Headroom TTS servers.
+Hot clips are held in a byte-budgeted in-memory LRU; the tts_cache directory
+is the second tier behind it and is kept within its own size budget by a
+background sweeper. Entry metadata lives in a SQLite index in the cache
+directory so entries can be listed and purged selectively.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+logger = logging.getLogger("tts-cache")
+
+# Cache settings (override with environment variables)
+TTS_MEMORY_CACHE_BYTES = int(os.environ.get("TTS_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+TTS_DISK_CACHE_BYTES = int(os.environ.get("TTS_DISK_CACHE_BYTES", str(1024 * 1024 * 1024)))
+TTS_DISK_CACHE_ENTRIES = int(os.environ.get("TTS_DISK_CACHE_ENTRIES", "20000"))
+TTS_CACHE_SWEEP_INTERVAL = float(os.environ.get("TTS_CACHE_SWEEP_INTERVAL", "60"))
+# Seconds of extra retention earned per second of synthesis time
+TTS_CACHE_COST_WEIGHT = float(os.environ.get("TTS_CACHE_COST_WEIGHT", "3600"))
+
+INDEX_NAME = ".index.sqlite3"
+
+# mkstemp creates files readable by their owner only; entries get the usual
+# umask-based mode instead so other users' server processes can share them.
+# The umask is read once at import, while no other threads are running.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+SWEEP_TARGET = 0.9  # evict down to 90% of the budget so sweeps are not back to back
+
+
+def cache_name(engine, audio_format, *parts):
+    """Return the cache file name for a synthesis request.
+
+    Names are namespaced by engine and output format, so two engines (or two
+    encodings) never share an entry even when their inputs are identical. The
+    key is a 128-bit BLAKE2b digest, which is faster than MD5 on 64-bit CPUs.
+    """
+    key = "\x1f".join(str(part) for part in (engine, audio_format) + parts)
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return f"{engine}-{digest}.{audio_format}"
+
+
+class MemoryLRU:
+    """Thread-safe LRU of immutable byte strings, bounded by their total size."""
+
+    def __init__(self, max_bytes=TTS_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class CacheEntry:
+    """Metadata for one file in the cache directory."""
+
+    __slots__ = ("name", "engine", "voice", "model", "size", "cost", "created", "last_access")
+
+    def __init__(self, name, engine="", voice="", model="", size=0, cost=0.0, created=None, last_access=None):
+        self.name = name
+        self.engine = engine
+        self.voice = voice
+        self.model = model
+        self.size = size
+        self.cost = cost
+        self.created = created if created is not None else time.time()
+        self.last_access = last_access if last_access is not None else self.created
+
+    def matches(self, engine=None, voice=None, model=None):
+        """True if the entry matches every filter that is not None."""
+        return ((engine is None or self.engine == engine) and
+                (voice is None or self.voice == voice) and
+                (model is None or self.model == model))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class CacheWriter:
+    """Writes a cache entry chunk by chunk, e.g. while audio is relayed from upstream.
+
+    Chunks go to a temporary file in the cache directory. commit() renames it
+    into place and indexes it; abort() deletes it, so a stream that fails or is
+    cut off never leaves a truncated entry behind.
+    """
+
+    def __init__(self, cache, name, engine="", voice="", model=""):
+        self.cache = cache
+        self.name = name
+        self.meta = (engine, voice, model)
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.cache_dir, prefix=".", suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+        os.fchmod(fd, FILE_MODE)
+        self.parts = []
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.parts.append(bytes(chunk))
+
+    def commit(self, cost=0.0):
+        """Store the entry; cost is the synthesis time in seconds. Returns the complete data."""
+        self.file.close()
+        os.replace(self.tmp_path, self.cache.path(self.name))
+        data = b"".join(self.parts)
+        self.cache.record(self.name, data, cost, *self.meta)
+        return data
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+class CacheIndex:
+    """Persistent SQLite record of the entries in a cache directory.
+
+    Every saved row gets a new sequence number, increasing across all the
+    processes sharing the index, so each process can pick up the rows the
+    others saved since it last looked, whatever their creation times.
+    """
+
+    FIELDS = CacheEntry.__slots__
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS entries ("
+              "seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, engine TEXT, voice TEXT, model TEXT, "
+              "size INTEGER, cost REAL, created REAL, last_access REAL)")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]
+            if columns and "seq" not in columns:
+                # Indexes written before rows had sequence numbers are rebuilt with them
+                fields = ", ".join(self.FIELDS)
+                self.db.execute("ALTER TABLE entries RENAME TO entries_unsequenced")
+                self.db.execute(self.SCHEMA)
+                self.db.execute(f"INSERT INTO entries ({fields}) SELECT {fields} FROM entries_unsequenced")
+                self.db.execute("DROP TABLE entries_unsequenced")
+            else:
+                self.db.execute(self.SCHEMA)
+
+    def load(self, after=0):
+        """Return (entries, seq): the entries saved after sequence number after, and the last sequence number."""
+        with self.lock:
+            rows = self.db.execute(f"SELECT seq, {', '.join(self.FIELDS)} FROM entries WHERE seq > ? ORDER BY seq",
+                                   (after,)).fetchall()
+        last = rows[-1][0] if rows else after
+        return [CacheEntry(*row[1:]) for row in rows], last
+
+    def save(self, entries, removed):
+        """Upsert entries and delete the names in removed, in one transaction."""
+        placeholders = ", ".join("?" for _ in self.FIELDS)
+        with self.lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO entries ({', '.join(self.FIELDS)}) VALUES ({placeholders})",
+                [tuple(getattr(entry, field) for field in self.FIELDS) for entry in entries],
+            )
+            self.db.executemany("DELETE FROM entries WHERE name = ?", [(name,) for name in removed])
+
+
+class AudioCache:
+    """Two-tier audio cache: an in-memory LRU in front of a cache directory.
+
+    Entries are addressed by file name (see cache_name()). Disk hits are
+    promoted into memory so repeated requests never touch the filesystem.
+
+    Every disk entry is recorded in an in-memory index (engine, voice, model,
+    size, synthesis cost, last access) that is persisted to SQLite by the
+    background sweeper, so startup does not scan the directory and lookups
+    for missing entries are answered without a filesystem call. The sweeper
+    also evicts entries whenever the directory exceeds its byte or entry
+    budget. Eviction is cost-aware: each second an entry took to synthesize
+    counts as TTS_CACHE_COST_WEIGHT seconds of extra recency, so a slow
+    ElevenLabs clip outlives a cheap tone.
+    """
+
+    def __init__(self, cache_dir, memory_bytes=TTS_MEMORY_CACHE_BYTES,
+                 disk_bytes=TTS_DISK_CACHE_BYTES, disk_entries=TTS_DISK_CACHE_ENTRIES,
+                 sweep_interval=TTS_CACHE_SWEEP_INTERVAL):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.memory = MemoryLRU(memory_bytes)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.max_disk_bytes = disk_bytes
+        self.max_disk_entries = disk_entries
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.removed = set()
+
+        index_path = self.path(INDEX_NAME)
+        self.indexed = os.path.exists(index_path)
+        self.index = CacheIndex(index_path)
+        entries, self.last_seq = self.index.load()
+        self.entries = {entry.name: entry for entry in entries}
+        self.disk_size = sum(entry.size for entry in self.entries.values())
+        if self.indexed:
+            logger.info(f"Loaded cache index: {len(self.entries)} entries, {self.disk_size} bytes")
+
+        # Synthesis worker processes import the server module too; only the
+        # server process maintains the directory
+        if sweep_interval > 0 and multiprocessing.parent_process() is None:
+            self.sweeper = threading.Thread(target=self.sweep_loop, name="tts-cache-sweeper", daemon=True)
+            self.sweeper.start()
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, name):
+        """Return the cached bytes for name, or None on a miss."""
+        data = self.memory.get(name)
+        if data is not None:
+            self.memory_hits += 1
+            self.touch(name, len(data))
+            return data
+        if self.indexed and name not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            with open(self.path(name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            self.forget([name])
+            return None
+        self.disk_hits += 1
+        self.touch(name, len(data))
+        self.memory.put(name, data)
+        return data
+
+    def put(self, name, data, cost=0.0, engine="", voice="", model=""):
+        """Store data in both tiers; cost is the synthesis time in seconds.
+
+        The file is written under a temporary name and renamed into place, so
+        readers in other threads or processes never see a partial file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".", suffix=".tmp")
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(name))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.record(name, data, cost, engine, voice, model)
+
+    def writer(self, name, engine="", voice="", model=""):
+        """Return a CacheWriter that stores name from chunks as they arrive."""
+        return CacheWriter(self, name, engine, voice, model)
+
+    def record(self, name, data, cost, engine, voice, model):
+        """Add a file that has just been renamed into place to the memory tier and index."""
+        self.memory.put(name, data)
+        entry = CacheEntry(name, engine, voice, model, len(data), cost)
+        with self.lock:
+            old = self.entries.get(name)
+            if old is not None:
+                self.disk_size -= old.size
+            self.entries[name] = entry
+            self.disk_size += entry.size
+            self.dirty.add(name)
+            self.removed.discard(name)
+
+    def touch(self, name, size):
+        """Record an access, adding entries written by other processes to the index."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.entries[name] = CacheEntry(name, size=size)
+                self.disk_size += size
+            else:
+                entry.last_access = time.time()
+            self.dirty.add(name)
+
+    def forget(self, names):
+        """Drop entries from the index and memory tier and delete their files."""
+        with self.lock:
+            for name in names:
+                entry = self.entries.pop(name, None)
+                if entry is not None:
+                    self.disk_size -= entry.size
+                self.dirty.discard(name)
+                self.removed.add(name)
+        for name in names:
+            self.memory.discard(name)
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    # Index maintenance
+
+    def scan(self):
+        """Index files that are on disk but not in the index (only for a new index)."""
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if item.name.startswith(".") or not item.is_file():
+                    continue
+                stat = item.stat()
+                found.append(CacheEntry(item.name, size=stat.st_size, created=stat.st_mtime,
+                                        last_access=stat.st_atime))
+        with self.lock:
+            for entry in found:
+                if entry.name not in self.entries:
+                    self.entries[entry.name] = entry
+                    self.disk_size += entry.size
+                    self.dirty.add(entry.name)
+        self.indexed = True
+        logger.info(f"Indexed cache directory: {len(self.entries)} entries, {self.disk_size} bytes")
+
+    def flush(self):
+        """Write changed entries to the index and pick up entries added by other processes."""
+        with self.lock:
+            changed = [self.entries[name] for name in self.dirty if name in self.entries]
+            removed = list(self.removed)
+            self.dirty.clear()
+            self.removed.clear()
+        self.index.save(changed, removed)
+        saved, self.last_seq = self.index.load(after=self.last_seq)
+        added = [entry for entry in saved if entry.name not in self.entries]
+        if added:
+            with self.lock:
+                for entry in added:
+                    if entry.name not in self.entries:
+                        self.entries[entry.name] = entry
+                        self.disk_size += entry.size
+
+    def sweep(self):
+        """Evict entries until the directory is back within its budgets."""
+        with self.lock:
+            over_bytes = self.max_disk_bytes > 0 and self.disk_size > self.max_disk_bytes
+            over_entries = self.max_disk_entries > 0 and len(self.entries) > self.max_disk_entries
+            if not (over_bytes or over_entries):
+                return 0
+            target_bytes = self.max_disk_bytes * SWEEP_TARGET if self.max_disk_bytes > 0 else float("inf")
+            target_entries = self.max_disk_entries * SWEEP_TARGET if self.max_disk_entries > 0 else float("inf")
+            ranked = sorted(self.entries.values(),
+                            key=lambda entry: entry.last_access + entry.cost * TTS_CACHE_COST_WEIGHT)
+            victims = []
+            size, count = self.disk_size, len(self.entries)
+            for entry in ranked:
+                if size <= target_bytes and count <= target_entries:
+                    break
+                victims.append(entry.name)
+                size -= entry.size
+                count -= 1
+
+        self.forget(victims)
+        self.evictions += len(victims)
+        logger.info(f"Evicted {len(victims)} cache entries, {self.disk_size} bytes remain")
+        return len(victims)
+
+    def sweep_loop(self):
+        if not self.indexed:
+            self.scan()
+        while True:
+            try:
+                self.sweep()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Cache sweep failed: {e}")
+            time.sleep(self.sweep_interval)
+
+    # Admin
+
+    def select(self, engine=None, voice=None, model=None):
+        with self.lock:
+            return [entry for entry in self.entries.values() if entry.matches(engine, voice, model)]
+
+    def purge(self, engine=None, voice=None, model=None):
+        """Delete every entry matching the filters. Returns (entries, bytes) removed."""
+        victims = self.select(engine, voice, model)
+        self.forget([entry.name for entry in victims])
+        removed_bytes = sum(entry.size for entry in victims)
+        logger.info(f"Purged {len(victims)} cache entries ({removed_bytes} bytes) for "
+                    f"engine={engine}, voice={voice}, model={model}")
+        return len(victims), removed_bytes
+
+    def summary(self):
+        """Entry counts and sizes grouped by engine, voice and model."""
+        groups = {}
+        for entry in self.select():
+            key = (entry.engine, entry.voice, entry.model)
+            group = groups.setdefault(key, {"engine": entry.engine, "voice": entry.voice,
+                                            "model": entry.model, "entries": 0, "bytes": 0})
+            group["entries"] += 1
+            group["bytes"] += entry.size
+        return sorted(groups.values(), key=lambda group: -group["bytes"])
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "memory_entries": len(self.memory.entries),
+            "memory_bytes": self.memory.size,
+            "memory_limit_bytes": self.memory.max_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "disk_entries": len(self.entries),
+            "disk_bytes": self.disk_size,
+            "disk_limit_bytes": self.max_disk_bytes,
+            "disk_limit_entries": self.max_disk_entries,
+            "evictions": self.evictions,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,1065 @@
+#!/usr/bin/env python3
+"""
+Shared asyncio HTTP server core for the Headroom TTS servers.
+Each server provides a TTSEngine; the core handles HTTP/1.1 keep-alive, CORS,
+the /health, /voices, /models and /tts endpoints, and runs blocking synthesis
+in a thread pool so slow upstream calls never stall other connections.
+"""
+
+import io
+import os
+import re
+import json
+import mmap
+import time
+import uuid
+import hashlib
+import hmac
+import tempfile
+import asyncio
+import logging
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from tts_audio import (AUDIO_FORMATS, SegmentStreamer, audio_formats, ffmpeg_encoders, join_segments,
+                       read_wav, source_format, transcode)
+from tts_cache import cache_name
+
+logger = logging.getLogger("tts-core")
+
+# Server settings (override with environment variables)
+PORT = 8008
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "8"))
+# Threads synthesizing the sentences of one text concurrently, shared by all requests
+TTS_SENTENCE_WORKERS = int(os.environ.get("TTS_SENTENCE_WORKERS", str(TTS_WORKERS)))
+TTS_QUEUE_SIZE = int(os.environ.get("TTS_QUEUE_SIZE", "32"))
+TTS_RETRY_AFTER = int(os.environ.get("TTS_RETRY_AFTER", "1"))
+TTS_KEEPALIVE_TIMEOUT = float(os.environ.get("TTS_KEEPALIVE_TIMEOUT", "15"))
+TTS_STREAM_PREFETCH = int(os.environ.get("TTS_STREAM_PREFETCH", "2"))
+TTS_BATCH_MAX_ITEMS = int(os.environ.get("TTS_BATCH_MAX_ITEMS", "100"))
+TTS_VOICES_TTL = float(os.environ.get("TTS_VOICES_TTL", "300"))
+# Token required by POST /cache/purge when set (sent as "Authorization: Bearer <token>")
+TTS_ADMIN_TOKEN = os.environ.get("TTS_ADMIN_TOKEN", "")
+# Synthesis processes for CPU-bound engines; -1 means one per core on multi-core machines
+TTS_PROCESSES = int(os.environ.get("TTS_PROCESSES", "-1"))
+# Where synthesis processes put the audio they hand to the server (tmpfs when available)
+TTS_SEGMENT_DIR = os.environ.get("TTS_SEGMENT_DIR") or (
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+MAX_BODY_SIZE = 1024 * 1024  # 1 MB of JSON is far more text than any response
+
+# Sentence boundaries: closing punctuation followed by whitespace, or line breaks
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+
+def audio_content_type(data, default="audio/wav"):
+    """Guess the MIME type of an audio blob from its magic bytes."""
+    if data[:4] == b"RIFF":
+        return "audio/wav"
+    if data[:3] == b"ID3" or data[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "audio/mpeg"
+    if data[:4] == b"OggS":
+        return AUDIO_FORMATS["opus"][0]
+    return default
+
+
+def audio_extension(content_type):
+    """File extension for an audio MIME type."""
+    return {"audio/wav": "wav", "audio/mpeg": "mp3", AUDIO_FORMATS["opus"][0]: "ogg"}.get(content_type, "bin")
+
+
+def parse_accept(header):
+    """Return {media type: quality} for an Accept header."""
+    accepted = {}
+    for entry in header.split(","):
+        media_type, *options = [part.strip() for part in entry.split(";")]
+        if not media_type:
+            continue
+        quality = 1.0
+        for option in options:
+            name, _, value = option.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.lower()] = max(quality, accepted.get(media_type.lower(), 0.0))
+    return accepted
+
+
+def split_sentences(text):
+    """Split text into normalized sentences, keeping their closing punctuation.
+
+    Runs of whitespace are collapsed so the same sentence always produces the
+    same cache key, however it was wrapped in the original text.
+    """
+    sentences = [" ".join(s.split()) for s in SENTENCE_BOUNDARY.split(text)]
+    return [s for s in sentences if s] or [text]
+
+
+def is_truthy(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+class HTTPError(Exception):
+    """Raised by request handlers to send an error response."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class FallbackAudio(bytes):
+    """Audio an engine returns in place of speech (a tone, silence, another service's voice).
+
+    It is sent like any other audio but never cached as a synthesis result,
+    so the real voice is used once the engine recovers.
+    """
+
+
+class Request:
+    """A parsed HTTP request."""
+
+    def __init__(self, method, path, version, headers, body=b""):
+        self.method = method
+        self.path, _, self.query = path.partition("?")
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Decode the request body as a JSON object.
+
+        GET requests carry their parameters in the query string instead.
+        """
+        if self.method == "GET":
+            return {key: values[-1] for key, values in parse_qs(self.query).items()}
+        try:
+            data = json.loads(self.body.decode() or "{}")
+        except (UnicodeDecodeError, ValueError) as e:
+            raise HTTPError(400, f"Invalid JSON body: {e}")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        return data
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class Response:
+    """A complete HTTP response."""
+
+    def __init__(self, status=200, body=b"", content_type="application/json", headers=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status=200, headers=None):
+        return cls(status, json.dumps(data).encode(), "application/json", headers)
+
+
+class StreamingResponse:
+    """A response whose body is produced by an async iterator and sent chunked."""
+
+    def __init__(self, chunks, content_type, status=200, headers=None, on_close=None):
+        self.status = status
+        self.chunks = chunks
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.on_close = on_close
+
+    async def close(self):
+        """Stop the body iterator and run the cleanup callback, even if nothing was sent."""
+        await self.chunks.aclose()
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+
+
+class TTSEngine:
+    """Base class for the speech engines plugged into TTSServer.
+
+    Subclasses implement synthesize(); it is called from a worker thread so it may
+    block on synthesis, disk or network I/O.
+    """
+
+    name = "tts"
+    segmented = True  # synthesize (and cache) each sentence separately
+    default_voice = "default"
+    default_model = "default"
+    content_type = "audio/wav"
+    cache = None  # AudioCache used by the engine, reported on /health
+    cpu_bound = False  # synthesis holds the GIL, so TTSServer gives it a process pool
+    processes = None  # ProcessPoolExecutor used by offload_audio(), set by TTSServer
+
+    def health(self):
+        """Return the /health payload."""
+        return {"status": "ok", "engine": self.name}
+
+    def get_voices(self):
+        """Return the list of available voices."""
+        return []
+
+    def voices_version(self):
+        """Return a value that changes whenever get_voices() changes, e.g. a loading state.
+
+        The server caches the voice list and fetches it again as soon as this
+        changes, besides refreshing it every TTS_VOICES_TTL seconds.
+        """
+        return None
+
+    def get_models(self):
+        """Return the list of available models."""
+        return []
+
+    def synthesize(self, text, voice_id, model):
+        """Return audio bytes for text.
+
+        For segmented engines text is a single sentence, so any cache kept by
+        the engine works per sentence.
+        """
+        raise NotImplementedError
+
+    @property
+    def native_format(self):
+        """The format synthesize() produces, "wav" or "mp3"."""
+        return "mp3" if self.content_type == "audio/mpeg" else "wav"
+
+    def synthesize_as(self, text, voice_id, model, audio_format):
+        """Synthesize a whole text and convert it to audio_format ("wav", "mp3" or "opus").
+
+        Converted audio is cached next to the engine's own entries, so a repeated
+        request costs neither synthesis nor encoding, unless any of it is
+        FallbackAudio. If the conversion fails the audio is returned as synthesized.
+        """
+        key = cache_name(self.name, audio_format, "encoded", text, voice_id, model)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        start_time = time.time()
+        audio_data = self.synthesize_text(text, voice_id, model)
+        if source_format(audio_data) == audio_format:
+            return audio_data
+        try:
+            encoded = transcode(audio_data, audio_format)
+        except Exception as e:
+            logger.warning(f"Cannot convert audio to {audio_format}, sending it as is: {str(e)}")
+            return audio_data
+        if isinstance(audio_data, FallbackAudio):
+            return FallbackAudio(encoded)
+        if self.cache is not None:
+            self.cache.put(key, encoded, cost=time.time() - start_time,
+                           engine=self.name, voice=voice_id, model=model)
+        return encoded
+
+    def open_stream(self, text, voice_id, model):
+        """Return an iterator over the audio of one sentence, chunk by chunk as it is produced.
+
+        Engines whose upstream delivers audio progressively override this so
+        streamed responses relay it before the sentence is complete. Returning
+        None (the default) synthesizes the sentence whole with synthesize().
+        The iterator is consumed, and closed, from worker threads.
+        """
+        return None
+
+    def synthesize_text(self, text, voice_id, model):
+        """Synthesize a whole text, one sentence at a time for segmented engines.
+
+        Sentences already in the engine's cache are reused and only the missing
+        ones are synthesized, concurrently on a pool shared by all requests,
+        before the segments are joined into one file. The result is
+        FallbackAudio if any sentence was.
+        """
+        if not self.segmented:
+            return self.synthesize(text, voice_id, model)
+        sentences = split_sentences(text)
+        unique = list(dict.fromkeys(sentences))
+        if len(unique) == 1:
+            audio = {unique[0]: self.synthesize(unique[0], voice_id, model)}
+        else:
+            results = sentence_pool.map(lambda sentence: self.synthesize(sentence, voice_id, model), unique)
+            audio = dict(zip(unique, results))
+        joined = join_segments([audio[sentence] for sentence in sentences], self.native_format)
+        if any(isinstance(segment, FallbackAudio) for segment in audio.values()):
+            return FallbackAudio(joined)
+        return joined
+
+    def fallback_audio(self):
+        """Return audio to send when synthesize() fails, or None to send a 500."""
+        return None
+
+    def start(self):
+        """Called once the server is listening; start slow background work such as loading models."""
+
+    def warm_up(self):
+        """Prepare a freshly started synthesis process (load models, fill tables)."""
+
+    def offload_audio(self, method, *args):
+        """Call an engine method that renders audio in a synthesis process, if there is a process pool.
+
+        The method runs on the worker process's own engine instance, so it must
+        only depend on its arguments (not on the cache or other server state);
+        the arguments are pickled. It is called with an extra allocate(size)
+        argument returning a writable buffer, and returns that buffer once
+        filled. In a synthesis process the buffer is a memory-mapped segment
+        file that the server maps and serves from directly, so the audio is
+        neither pickled nor copied on its way back. Without a pool the method
+        runs in this thread and the buffer is a bytearray.
+        """
+        if self.processes is not None:
+            try:
+                path, size = self.processes.submit(call_engine_audio, method.__name__, *args).result()
+                return open_segment(path, size)
+            except BrokenProcessPool:
+                logger.error("Synthesis process pool is broken, synthesizing in worker threads")
+                self.processes = None
+        return method(*args, allocate=bytearray)
+
+
+# Sentence synthesis threads for TTSEngine.synthesize_text(). They never wait
+# on the pool themselves, so worker threads can block on it without deadlock.
+sentence_pool = ThreadPoolExecutor(max_workers=max(1, TTS_SENTENCE_WORKERS), thread_name_prefix="tts-sentence")
+
+# Engine instance of a synthesis worker process
+worker_engine = None
+
+
+def init_worker(engine_class):
+    """Process pool initializer: create the engine once per process and warm it up."""
+    global worker_engine
+    worker_engine = engine_class()
+    worker_engine.warm_up()
+
+
+def call_engine_audio(method, *args):
+    """Run an engine method that renders into allocate()d segments; return (path, size) of its result."""
+    segments = []
+
+    def allocate(size):
+        fd, path = tempfile.mkstemp(prefix=f"tts-segment-{os.getppid()}-", dir=TTS_SEGMENT_DIR)
+        try:
+            os.ftruncate(fd, size)
+            segment = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        os.close(fd)
+        segments.append((path, segment))
+        return memoryview(segment)
+
+    kept = None
+    try:
+        result = getattr(worker_engine, method)(*args, allocate=allocate)
+        for path, segment in segments:
+            if segment is result.obj:
+                kept = path
+        if kept is None:
+            raise ValueError(f"{method} did not return an allocated buffer")
+        size = result.nbytes
+        result.release()
+        return kept, size
+    finally:
+        for path, segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                pass  # still referenced from a traceback; unmapped once that is gone
+            if path != kept:
+                os.unlink(path)
+
+
+def open_segment(path, size):
+    """Map a segment written by a synthesis process and return it as a read-only memoryview.
+
+    The file is unlinked straight away; the mapping lives as long as the view.
+    """
+    try:
+        with open(path, "rb") as f:
+            segment = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        os.unlink(path)
+    return memoryview(segment)
+
+
+def remove_segments(pid):
+    """Delete segment files a server process left behind (e.g. results of cancelled requests)."""
+    prefix = f"tts-segment-{pid}-"
+    for name in os.listdir(TTS_SEGMENT_DIR):
+        if name.startswith(prefix):
+            try:
+                os.unlink(os.path.join(TTS_SEGMENT_DIR, name))
+            except OSError:
+                pass
+
+
+def worker_ready():
+    return os.getpid()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution.
+
+    The first caller starts the work as its own task; callers arriving while it
+    is in flight wait on the same task and share its result. A waiter that
+    disconnects does not cancel the work for the others.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.finish(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def finish(self, key, task):
+        self.calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # mark as retrieved even if every waiter went away
+
+
+class VoiceCatalog:
+    """The engine's voice list, kept as pre-serialized JSON with an ETag.
+
+    Requests are answered from the stored body. Once it is older than the TTL
+    the next request starts a refresh in the background but is still answered
+    with the stale copy (stale-while-revalidate), so only a request arriving
+    before the very first fetch completes waits on the engine. When the
+    engine's voices_version() changes the list is fetched again before
+    answering, since that is a local change rather than an upstream call.
+    """
+
+    def __init__(self, fetch, version, ttl=TTS_VOICES_TTL):
+        self.fetch = fetch  # coroutine function returning the list of voices
+        self.version = version
+        self.ttl = ttl
+        self.body = None
+        self.etag = None
+        self.fetched = 0.0
+        self.fetched_version = None
+        self.refreshing = None
+
+    def refresh(self):
+        """Start fetching the voice list unless a fetch is running, and return its task."""
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self.load())
+            self.refreshing.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return self.refreshing
+
+    async def load(self):
+        try:
+            version = self.version()
+            voices = await self.fetch()
+            self.fetched_version = version
+            self.body = json.dumps({"voices": voices}).encode()
+            self.etag = '"%s"' % hashlib.blake2b(self.body, digest_size=16).hexdigest()
+            self.fetched = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error fetching voices: {str(e)}")
+            if self.body is None:
+                raise
+        finally:
+            self.refreshing = None
+
+    async def get(self):
+        """Return (body, etag), fetching the voice list only if there is none yet."""
+        if self.body is None or self.version() != self.fetched_version:
+            await asyncio.shield(self.refresh())
+        elif time.monotonic() - self.fetched >= self.ttl:
+            self.refresh()
+        return self.body, self.etag
+
+
+class TTSServer:
+    """Asyncio HTTP server exposing a TTSEngine on the Headroom TTS API."""
+
+    def __init__(self, engine, host="", port=PORT, workers=TTS_WORKERS,
+                 queue_size=TTS_QUEUE_SIZE, retry_after=TTS_RETRY_AFTER, processes=TTS_PROCESSES):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.max_pending = self.workers + max(0, queue_size)
+        self.retry_after = retry_after
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tts-worker")
+        if processes < 0:
+            cores = os.cpu_count() or 1
+            processes = cores if cores > 1 else 0
+        self.process_count = processes if engine.cpu_bound else 0
+        self.processes_ready = 0
+        self.processes = None
+        if self.process_count:
+            # Worker threads keep handling the cache and wait on the processes,
+            # which do the GIL-bound part of synthesis on every core
+            self.processes = ProcessPoolExecutor(self.process_count, multiprocessing.get_context("spawn"),
+                                                 initializer=init_worker, initargs=(type(engine),))
+            engine.processes = self.processes
+        self.pending = 0
+        self.rejected = 0
+        self.flights = SingleFlight()
+        self.voices = VoiceCatalog(lambda: self.submit(self.engine.get_voices), self.engine.voices_version)
+        self.routes = {
+            ("GET", "/health"): self.handle_health,
+            ("GET", "/voices"): self.handle_voices,
+            ("GET", "/models"): self.handle_models,
+            ("GET", "/tts"): self.handle_tts,
+            ("POST", "/tts"): self.handle_tts,
+            ("POST", "/tts/batch"): self.handle_tts_batch,
+            ("GET", "/cache"): self.handle_cache_stats,
+            ("GET", "/cache/entries"): self.handle_cache_entries,
+            ("POST", "/cache/purge"): self.handle_cache_purge,
+        }
+
+    def reserve(self):
+        """Claim a place on the worker pool, or raise a 503 if it is saturated."""
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"Worker queue full ({self.pending} pending), rejecting request with 503")
+            raise HTTPError(503, "Server busy", {"Retry-After": str(self.retry_after)})
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+
+    def submit(self, func, *args):
+        """Schedule a blocking call on the worker pool and return an awaitable future."""
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def run_blocking(self, func, *args):
+        """Run a blocking call on the worker pool, rejecting it if the pool is saturated."""
+        self.reserve()
+        try:
+            return await self.submit(func, *args)
+        finally:
+            self.release()
+
+    # Endpoints
+
+    async def handle_health(self, request):
+        logger.info("Health check request received")
+        payload = self.engine.health()
+        payload["requests"] = {"pending": self.pending, "rejected": self.rejected,
+                               "coalesced": self.flights.coalesced}
+        if self.process_count:
+            payload["processes"] = {"count": self.process_count, "ready": self.processes_ready}
+        payload["formats"] = audio_formats(self.engine.native_format)
+        if self.engine.cache is not None:
+            payload["cache"] = self.engine.cache.stats()
+        return Response.json(payload)
+
+    async def handle_voices(self, request):
+        logger.info("Voices request received")
+        body, etag = await self.voices.get()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(304, headers=headers)
+        return Response(200, body, "application/json", headers)
+
+    async def handle_models(self, request):
+        logger.info("Models request received")
+        return Response.json({"models": self.engine.get_models()})
+
+    def require_cache(self):
+        if self.engine.cache is None:
+            raise HTTPError(404, "This engine has no cache")
+        return self.engine.cache
+
+    async def handle_cache_stats(self, request):
+        cache = self.require_cache()
+        return Response.json({"stats": cache.stats(), "groups": cache.summary()})
+
+    async def handle_cache_entries(self, request):
+        cache = self.require_cache()
+        params = request.json()
+        try:
+            limit = int(params.get("limit", 100))
+        except ValueError:
+            raise HTTPError(400, "limit must be an integer")
+        entries = cache.select(params.get("engine"), params.get("voice"), params.get("model"))
+        entries.sort(key=lambda entry: entry.last_access, reverse=True)
+        return Response.json({"total": len(entries), "entries": [entry.as_dict() for entry in entries[:limit]]})
+
+    def require_admin(self, request):
+        """Refuse destructive requests from other web pages, and without the admin token if one is set.
+
+        Responses carry Access-Control-Allow-Origin: *, so any page open in the
+        user's browser could otherwise call these endpoints.
+        """
+        origin = request.headers.get("origin")
+        if origin is not None and urlsplit(origin).netloc != request.headers.get("host"):
+            raise HTTPError(403, "Cross-site requests may not change the cache")
+        if TTS_ADMIN_TOKEN:
+            authorization = request.headers.get("authorization", "")
+            if not hmac.compare_digest(authorization.encode(), f"Bearer {TTS_ADMIN_TOKEN}".encode()):
+                raise HTTPError(401, "Admin token required", {"WWW-Authenticate": "Bearer"})
+
+    async def handle_cache_purge(self, request):
+        self.require_admin(request)
+        cache = self.require_cache()
+        params = request.json()
+        filters = {field: params.get(field) for field in ("engine", "voice", "model")}
+        if all(value is None for value in filters.values()) and not params.get("all"):
+            raise HTTPError(400, "Give engine, voice and/or model to purge, or \"all\": true")
+        removed, removed_bytes = await self.run_blocking(lambda: cache.purge(**filters))
+        return Response.json({"removed": removed, "bytes": removed_bytes})
+
+    async def handle_tts(self, request):
+        params = request.json()
+        text = params.get("text", "")
+        voice_id = params.get("speaker", self.engine.default_voice)
+        model = params.get("model", self.engine.default_model)
+        logger.info(f"TTS request: text='{text[:50]}...', voice='{voice_id}', model='{model}'")
+
+        if is_truthy(params.get("stream", False)):
+            return await self.stream_tts(text, voice_id, model)
+
+        audio_format = self.negotiate_format(params.get("format"), request.headers.get("accept", ""))
+        native = self.engine.native_format
+        # Raw PCM is cut from the WAV form without encoding
+        source = "wav" if audio_format == "pcm" else audio_format
+        try:
+            if source == native:
+                audio_data = await self.flights.do(
+                    ("text", text, voice_id, model),
+                    lambda: self.run_blocking(self.engine.synthesize_text, text, voice_id, model))
+            else:
+                audio_data = await self.flights.do(
+                    ("text", source, text, voice_id, model),
+                    lambda: self.run_blocking(self.engine.synthesize_as, text, voice_id, model, source))
+        except HTTPError:
+            raise
+        except Exception as e:
+            logger.error(f"Error handling TTS request: {str(e)}")
+            audio_data = self.engine.fallback_audio()
+            if audio_data is None:
+                raise HTTPError(500, str(e))
+
+        headers = {"Vary": "Accept"}
+        content_type = audio_content_type(audio_data, self.engine.content_type)
+        if audio_format == "pcm" and content_type == "audio/wav":
+            (channels, sample_width, sample_rate), audio_data = read_wav(audio_data)
+            content_type = (f"{AUDIO_FORMATS['pcm'][0]};rate={sample_rate};channels={channels};"
+                            f"bits={sample_width * 8}")
+        logger.info(f"Response sent successfully: {len(audio_data)} bytes")
+        return Response(200, audio_data, content_type, headers)
+
+    def negotiate_format(self, requested, accept):
+        """Pick the output format from the format field or else the Accept header.
+
+        An explicit format that cannot be produced is an error; Accept headers
+        are only followed as far as possible, falling back to the engine's
+        native format. Between equally acceptable formats the native one wins.
+        """
+        formats = audio_formats(self.engine.native_format)
+        if requested:
+            requested = "opus" if requested == "ogg" else requested
+            if requested not in AUDIO_FORMATS:
+                raise HTTPError(400, f"format must be one of: {', '.join(AUDIO_FORMATS)}")
+            if requested not in formats:
+                raise HTTPError(406, f"Audio is available as {', '.join(formats)}")
+            return requested
+
+        accepted = parse_accept(accept)
+        best, best_quality = formats[0], 0.0
+        for audio_format in formats:
+            media_types = AUDIO_FORMATS[audio_format][1]
+            matches = [accepted[media_type] for media_type in media_types if media_type in accepted]
+            if matches:
+                quality = max(matches)
+            else:
+                quality = accepted.get("audio/*", accepted.get("*/*", 0.0))
+            if quality > best_quality:
+                best, best_quality = audio_format, quality
+        return best
+
+    async def handle_tts_batch(self, request):
+        """Synthesize a list of {text, speaker, model} items concurrently.
+
+        Results are streamed as multipart/mixed parts in completion order, or
+        with "format": "zip" returned as a zip archive with an index.json. The
+        whole batch occupies a single place in the worker queue and runs at most
+        one item per worker at a time; identical items are synthesized once.
+        """
+        params = request.json()
+        items = params.get("items")
+        if not isinstance(items, list) or not items:
+            raise HTTPError(400, "items must be a non-empty list")
+        if len(items) > TTS_BATCH_MAX_ITEMS:
+            raise HTTPError(400, f"A batch can have at most {TTS_BATCH_MAX_ITEMS} items")
+        result_format = params.get("format", "multipart")
+        if result_format not in ("multipart", "zip"):
+            raise HTTPError(400, "format must be \"multipart\" or \"zip\"")
+
+        jobs = []
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+                raise HTTPError(400, "Each item must be an object with a text field")
+            jobs.append((item["text"], item.get("speaker", self.engine.default_voice),
+                         item.get("model", self.engine.default_model)))
+        logger.info(f"Batch TTS request: {len(jobs)} items, {len(set(jobs))} unique")
+
+        self.reserve()
+        limit = asyncio.Semaphore(self.workers)
+
+        async def synthesize(index, text, voice_id, model):
+            async with limit:
+                try:
+                    audio_data = await self.flights.do(
+                        ("text", text, voice_id, model),
+                        lambda: self.submit(self.engine.synthesize_text, text, voice_id, model))
+                    return index, audio_data, None
+                except Exception as e:
+                    logger.error(f"Error synthesizing batch item {index}: {str(e)}")
+                    return index, None, str(e)
+
+        tasks = [asyncio.ensure_future(synthesize(index, *job)) for index, job in enumerate(jobs)]
+
+        def cleanup():
+            for task in tasks:
+                task.cancel()
+            self.release()
+
+        if result_format == "zip":
+            try:
+                results = await asyncio.gather(*tasks)
+            finally:
+                cleanup()
+            archive = await self.submit(self.build_batch_archive, jobs, results)
+            return Response(200, archive, "application/zip",
+                            {"Content-Disposition": 'attachment; filename="tts-batch.zip"'})
+
+        boundary = uuid.uuid4().hex
+
+        async def parts():
+            for task in asyncio.as_completed(tasks):
+                index, audio_data, error = await task
+                if error is None:
+                    content_type = audio_content_type(audio_data, self.engine.content_type)
+                    body = audio_data
+                else:
+                    content_type = "application/json"
+                    body = json.dumps({"error": error}).encode()
+                head = (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                        f"Content-Length: {len(body)}\r\nX-Item-Index: {index}\r\n\r\n")
+                yield head.encode("latin-1") + body + b"\r\n"
+            yield f"--{boundary}--\r\n".encode("latin-1")
+
+        return StreamingResponse(parts(), f"multipart/mixed; boundary={boundary}", on_close=cleanup)
+
+    def build_batch_archive(self, jobs, results):
+        """Pack batch results into a zip archive with an index.json describing each item."""
+        index_entries = []
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            for (text, voice_id, model), (index, audio_data, error) in zip(jobs, results):
+                entry = {"index": index, "text": text, "speaker": voice_id, "model": model}
+                if error is None:
+                    content_type = audio_content_type(audio_data, self.engine.content_type)
+                    entry["file"] = f"{index:04d}.{audio_extension(content_type)}"
+                    entry["content_type"] = content_type
+                    entry["bytes"] = len(audio_data)
+                    archive.writestr(entry["file"], audio_data)
+                else:
+                    entry["error"] = error
+                index_entries.append(entry)
+            archive.writestr("index.json", json.dumps({"items": index_entries}, indent=2))
+        return buffer.getvalue()
+
+    async def relay_sentence(self, sentence, voice_id, model, queue):
+        """Synthesize one sentence of a stream, putting its chunks on queue as they are produced.
+
+        Returns the complete audio of the sentence. When the engine streams it
+        (see TTSEngine.open_stream) the chunks are queued as they arrive;
+        otherwise, or when an identical sentence is already in flight, nothing
+        is queued. A None on the queue marks the end either way.
+        """
+        async def relay():
+            chunks = await self.submit(self.engine.open_stream, sentence, voice_id, model)
+            if chunks is None:
+                return await self.submit(self.engine.synthesize, sentence, voice_id, model)
+            parts = []
+            try:
+                while True:
+                    chunk = await self.submit(next, chunks, None)
+                    if chunk is None:
+                        return b"".join(parts)
+                    parts.append(chunk)
+                    queue.put_nowait(chunk)
+            finally:
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    await self.submit(close)
+
+        try:
+            return await self.flights.do(("sentence", sentence, voice_id, model), relay)
+        finally:
+            queue.put_nowait(None)
+
+    async def stream_tts(self, text, voice_id, model):
+        """Synthesize sentence by sentence and stream each one as soon as it is ready.
+
+        Up to TTS_STREAM_PREFETCH sentences are synthesized ahead of the one being
+        sent, and audio the engine produces progressively is relayed chunk by
+        chunk. The whole stream occupies a single place in the worker queue.
+        """
+        sentences = split_sentences(text)
+        self.reserve()
+        pending = deque()
+        current = []
+        upcoming = iter(sentences)
+
+        def schedule():
+            for sentence in upcoming:
+                queue = asyncio.Queue()
+                pending.append((queue, asyncio.ensure_future(
+                    self.relay_sentence(sentence, voice_id, model, queue))))
+                if len(pending) >= max(1, TTS_STREAM_PREFETCH):
+                    break
+
+        def cleanup():
+            for _, future in list(pending) + current:
+                future.cancel()
+            self.release()
+
+        async def segment_chunks(queue, future, first=None):
+            """Yield a sentence's chunks as they are queued, or its whole audio if none were."""
+            current[:] = [(queue, future)]
+            relayed = first is not None
+            if relayed:
+                yield first
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                relayed = True
+                yield chunk
+            data = await future
+            if not relayed:
+                yield data
+
+        schedule()
+        queue, future = pending.popleft()
+        try:
+            first = await queue.get()
+            if first is None:
+                # Nothing was relayed; the whole sentence follows the end marker
+                first = await future
+                queue.put_nowait(None)
+        except Exception as e:
+            cleanup()
+            logger.error(f"Error handling TTS request: {str(e)}")
+            audio_data = self.engine.fallback_audio()
+            if audio_data is None:
+                raise HTTPError(500, str(e))
+            return Response(200, audio_data, audio_content_type(audio_data, self.engine.content_type))
+
+        async def chunks():
+            streamer = SegmentStreamer()
+            sent = 0
+            try:
+                segment = segment_chunks(queue, future, first)
+                while True:
+                    schedule()
+                    # The first chunk of each sentence carries its container header;
+                    # a sentence the streamer skips is left out whole
+                    start, keep = True, True
+                    async for data in segment:
+                        if start:
+                            start = False
+                            data = streamer.feed(data)
+                            keep = data is not None
+                        if keep:
+                            sent += len(data)
+                            yield data
+                    if not pending:
+                        break
+                    segment = segment_chunks(*pending.popleft())
+                logger.info(f"Streamed {len(sentences)} sentences: {sent} bytes")
+            except Exception as e:
+                logger.error(f"Error while streaming TTS response: {str(e)}")
+
+        logger.info(f"Streaming {len(sentences)} sentences")
+        return StreamingResponse(chunks(), audio_content_type(first, self.engine.content_type),
+                                 on_close=cleanup)
+
+    # HTTP plumbing
+
+    async def dispatch(self, request):
+        if request.method == "OPTIONS":
+            return Response(200, headers={"Access-Control-Max-Age": "86400"})
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            logger.warning(f"Unknown {request.method} request for path: {request.path}")
+            return Response.json({"error": "Not found"}, status=404)
+        try:
+            return await handler(request)
+        except HTTPError as e:
+            return Response.json({"error": e.message}, status=e.status, headers=e.headers)
+        except Exception as e:
+            logger.exception(f"Unhandled error for {request.method} {request.path}")
+            return Response.json({"error": str(e)}, status=500)
+
+    async def read_request(self, reader, writer):
+        """Read one request from the connection, or return None on EOF/idle timeout."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), TTS_KEEPALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:
+            raise HTTPError(414, "Request line too long")
+        if not line:
+            return None
+        try:
+            method, path, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise HTTPError(431, "Too many headers")
+
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "Request body too large")
+        if length and headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method.upper(), path, version, headers, body)
+
+    def write_head(self, writer, status, headers):
+        reason = HTTPStatus(status).phrase
+        lines = [f"HTTP/1.1 {status} {reason}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send_response(self, writer, response, keep_alive):
+        headers = {"Content-Type": response.content_type}
+        if isinstance(response, StreamingResponse):
+            headers["Transfer-Encoding"] = "chunked"
+        elif response.status != 304:
+            headers["Content-Length"] = str(len(response.body))
+        headers.update(CORS_HEADERS)
+        headers.update(response.headers)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        self.write_head(writer, response.status, headers)
+
+        if isinstance(response, StreamingResponse):
+            await self.send_chunks(writer, response)
+        else:
+            writer.write(response.body)
+        await writer.drain()
+
+    async def send_chunks(self, writer, response):
+        """Write a streaming response body using chunked transfer encoding."""
+        try:
+            async for chunk in response.chunks:
+                if chunk:
+                    writer.write(b"%x\r\n" % len(chunk))
+                    writer.write(chunk)
+                    writer.write(b"\r\n")
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        finally:
+            await response.close()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, writer)
+                except HTTPError as e:
+                    await self.send_response(writer, Response.json({"error": e.message}, status=e.status), False)
+                    break
+                if request is None:
+                    break
+                start = time.perf_counter()
+                response = await self.dispatch(request)
+                keep_alive = request.keep_alive and response.status < 500
+                await self.send_response(writer, response, keep_alive)
+                logger.debug(f'"{request.method} {request.path}" {response.status} '
+                             f"{(time.perf_counter() - start) * 1000:.1f}ms")
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def serve_forever(self):
+        # Look for encoders before accepting requests, so audio_formats() never runs ffmpeg on the event loop
+        await self.submit(ffmpeg_encoders)
+        server = await asyncio.start_server(self.handle_connection, self.host or None, self.port,
+                                            reuse_address=True)
+        logger.info(f"Serving {self.engine.name} with {self.workers} workers, "
+                    f"{self.max_pending - self.workers} queued requests max")
+        if self.processes is not None:
+            asyncio.ensure_future(self.start_processes())
+        self.engine.start()
+        self.voices.refresh()
+        async with server:
+            await server.serve_forever()
+
+    async def start_processes(self):
+        """Start every synthesis process up front so the first requests don't pay for it."""
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        starting = [loop.run_in_executor(self.processes, worker_ready) for _ in range(self.process_count)]
+        for started in asyncio.as_completed(starting):
+            try:
+                await started
+            except Exception as e:
+                logger.error(f"Synthesis process failed to start: {e}")
+                return
+            self.processes_ready += 1
+        logger.info(f"Started {self.process_count} synthesis processes in "
+                    f"{time.perf_counter() - start:.1f}s")
+
+    def run(self):
+        """Serve until interrupted."""
+        try:
+            asyncio.run(self.serve_forever())
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            sentence_pool.shutdown(wait=False, cancel_futures=True)
+            if self.processes is not None:
+                self.processes.shutdown(wait=False, cancel_futures=True)
+                remove_segments(os.getpid())